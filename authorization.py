@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+from typing import Optional, Set
+from uuid import uuid4
+
+from telegram import InlineQueryResultArticle, InputTextMessageContent, Update
+from telegram.ext import ApplicationHandlerStop, CallbackContext
+
+
+class Authorizer:
+    whitelist: Optional[Set[int]]
+
+    def __init__(self, whitelist: Optional[Set[int]]) -> None:
+        self.whitelist = whitelist
+
+    def is_authorized(self, update: Update) -> bool:
+        if self.whitelist is None:
+            return True
+        return (update.effective_user is not None) and (
+            update.effective_user.id in self.whitelist
+        )
+
+    async def check(self, update: object, context: CallbackContext) -> None:
+        """
+        Runs before the handlers of the default group,
+        stopping unauthorized updates before any work is done for them
+        """
+        if not isinstance(update, Update) or self.is_authorized(update):
+            return
+
+        if update.inline_query is not None:
+            await update.inline_query.answer(
+                [
+                    InlineQueryResultArticle(
+                        id=str(uuid4()),
+                        title="Unauthorized user",
+                        input_message_content=InputTextMessageContent(
+                            "Unauthorized user"
+                        ),
+                    )
+                ],
+                cache_time=300,
+                is_personal=True,
+            )
+        elif update.callback_query is not None:
+            await update.callback_query.answer("Unauthorized user", show_alert=True)
+        elif update.message is not None:
+            await update.message.reply_text("Unauthorized user", quote=True)
+
+        raise ApplicationHandlerStop
@@ -1,18 +1,32 @@
 #!/usr/bin/env python3
+# Imported first so that startup times are measured from process start
+from startup import startup_report
+
 import logging
 import os
-from typing import List, Optional, Set
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
 
 from telegram import Update
 from telegram.ext import (
     Application,
     CallbackContext,
+    CallbackQueryHandler,
+    ChosenInlineResultHandler,
     CommandHandler,
     InlineQueryHandler,
+    TypeHandler,
 )
 
+import deadlines
+from authorization import Authorizer
 from error_handler import ErrorHandler
 from instagram import InstagramHandler
+from structured_logging import PayloadFormatter, configure_logging
+
+# Updates handled at once, so one slow lookup doesn't hold up everyone else's.
+# The fetcher's scheduler still bounds and orders the Instagram lookups.
+CONCURRENT_UPDATES = 256
 
 
 async def start(update: Update, context: CallbackContext) -> None:
@@ -21,31 +35,125 @@ async def start(update: Update, context: CallbackContext) -> None:
     await update.message.reply_text("Hi, lmao", quote=True)
 
 
+def add_handlers(
+    application: Application,
+    instagram_handler: InstagramHandler,
+    error_handler: ErrorHandler,
+    whitelist: Optional[Set[int]],
+) -> None:
+    application.add_error_handler(error_handler.error_handler)
+
+    # Lower groups run first: the deadline is set before anything else happens
+    application.add_handler(TypeHandler(Update, deadlines.start), group=-2)
+    # Then unauthorized updates are stopped before the default group does any work
+    application.add_handler(TypeHandler(Update, Authorizer(whitelist).check), group=-1)
+
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("p", instagram_handler.posts))
+    application.add_handler(CommandHandler("storyitem", instagram_handler.story_item))
+    application.add_handler(CommandHandler("profile", instagram_handler.profile))
+    application.add_handler(CommandHandler("profileid", instagram_handler.profile_id))
+
+    application.add_handler(CommandHandler("watch", instagram_handler.watcher.watch))
+    application.add_handler(
+        CommandHandler("unwatch", instagram_handler.watcher.unwatch)
+    )
+
+    application.add_handler(CommandHandler("status", instagram_handler.status))
+    application.add_handler(CommandHandler("memory", instagram_handler.memory))
+
+    application.add_handler(
+        CallbackQueryHandler(
+            instagram_handler.interactions, pattern=r"^(comments|likers):"
+        )
+    )
+
+    application.add_handler(InlineQueryHandler(instagram_handler.inlinequery))
+    application.add_handler(
+        ChosenInlineResultHandler(instagram_handler.chosen_inline_result)
+    )
+
+
+def run_application(
+    application: Application,
+    webhook_url: Optional[str] = None,
+    webhook_port: int = 8443,
+) -> None:
+    """Receives updates through a webhook if a URL is given, otherwise polls for them"""
+    if webhook_url is None:
+        application.run_polling()
+    else:
+        application.run_webhook(
+            listen="0.0.0.0", port=webhook_port, webhook_url=webhook_url
+        )
+
+
 def bot(
     token: str,
     ig_user: Optional[str],
     whitelist: Optional[Set[int]],
+    user_rate: Optional[float] = None,
+    user_burst: float = 5,
+    workers: int = 0,
+    webhook_url: Optional[str] = None,
+    webhook_port: int = 8443,
+    cache_path: Optional[Path] = None,
+    concurrency: int = 1,
+    admins: Optional[Set[int]] = None,
+    memory_budget: Optional[int] = None,
+    record_path: Optional[Path] = None,
+    replay_path: Optional[Path] = None,
+    max_queue_depth: Optional[int] = None,
+    metrics_port: Optional[int] = None,
+    warm_path: Optional[Path] = None,
 ) -> None:
-    with InstagramHandler(ig_user, whitelist) as instagram_handler, ErrorHandler(
-        whitelist
-    ) as error_handler:
-        application = Application.builder().token(token).build()
+    handler_kwargs: Dict[str, Any] = {
+        "ig_user": ig_user,
+        "user_rate": user_rate,
+        "user_burst": user_burst,
+        "cache_path": cache_path,
+        "concurrency": concurrency,
+        "admins": admins,
+    }
+    if memory_budget is not None:
+        handler_kwargs["memory_budget"] = memory_budget
+    if record_path is not None:
+        handler_kwargs["record_path"] = record_path
+    if replay_path is not None:
+        handler_kwargs["replay_path"] = replay_path
+    if max_queue_depth is not None:
+        handler_kwargs["max_queue_depth"] = max_queue_depth
+    if metrics_port is not None:
+        handler_kwargs["metrics_port"] = metrics_port
+    if warm_path is not None:
+        handler_kwargs["warm_path"] = warm_path
 
-        application.add_error_handler(error_handler.error_handler)
+    if workers > 0:
+        from sharding import run_sharded
 
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("p", instagram_handler.posts))
-        application.add_handler(
-            CommandHandler("storyitem", instagram_handler.story_item)
-        )
-        application.add_handler(CommandHandler("profile", instagram_handler.profile))
-        application.add_handler(
-            CommandHandler("profileid", instagram_handler.profile_id)
+        run_sharded(
+            token, workers, whitelist, handler_kwargs, webhook_url, webhook_port
         )
+        return
 
-        application.add_handler(InlineQueryHandler(instagram_handler.inlinequery))
+    with InstagramHandler(**handler_kwargs) as instagram_handler, ErrorHandler(
+        whitelist
+    ) as error_handler:
 
-        application.run_polling()
+        async def post_init(application: Application) -> None:
+            startup_report.mark("Polling")
+            await instagram_handler.start(application)
+
+        application = (
+            Application.builder()
+            .token(token)
+            .concurrent_updates(CONCURRENT_UPDATES)
+            .post_init(post_init)
+            .post_shutdown(instagram_handler.stop)
+            .build()
+        )
+        add_handlers(application, instagram_handler, error_handler, whitelist)
+        run_application(application, webhook_url, webhook_port)
 
 
 def main() -> None:
@@ -75,6 +183,14 @@ def main() -> None:
         dest="whitelist",
         help="Allow all Telegram Users to use this bot (This could cause rate limiting by Meta)",
     )
+    parser.add_argument(
+        "--admin",
+        action="append",
+        dest="admins",
+        metavar="Telegram User ID",
+        type=int,
+        help="Telegram User IDs allowed to use admin commands such as /memory",
+    )
     login = parser.add_mutually_exclusive_group(required=True)
     login.add_argument(
         "--no-login",
@@ -91,6 +207,115 @@ def main() -> None:
         type=str,
         help="Username through which Instaloader is ran",
     )
+    parser.add_argument(
+        "--user-rate",
+        action="store",
+        dest="user_rate",
+        metavar="Requests per minute",
+        type=float,
+        help="Instagram lookups each Telegram user may make per minute",
+    )
+    parser.add_argument(
+        "--user-burst",
+        action="store",
+        default=5,
+        dest="user_burst",
+        metavar="Requests",
+        type=float,
+        help="Instagram lookups each Telegram user may make in a burst",
+    )
+    parser.add_argument(
+        "--concurrency",
+        action="store",
+        default=1,
+        dest="concurrency",
+        metavar="Lookups",
+        type=int,
+        help="Instagram lookups run at the same time, sharing one HTTP/2 connection pool",
+    )
+    parser.add_argument(
+        "--max-queue",
+        action="store",
+        dest="max_queue_depth",
+        metavar="Lookups",
+        type=int,
+        help="Instagram lookups that may wait at once, beyond which requests are shed with a busy reply",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        action="store",
+        dest="metrics_port",
+        metavar="Port",
+        type=int,
+        help="Serves the lookup queue depth for autoscaling on this port, workers use the ports after it",
+    )
+    parser.add_argument(
+        "--workers",
+        action="store",
+        default=0,
+        dest="workers",
+        metavar="Count",
+        type=int,
+        help="Runs Instagram lookups in this many worker processes, each with its own session",
+    )
+    parser.add_argument(
+        "--webhook-url",
+        action="store",
+        dest="webhook_url",
+        metavar="URL",
+        type=str,
+        help="Receives updates through a webhook at this URL instead of polling",
+    )
+    parser.add_argument(
+        "--webhook-port",
+        action="store",
+        default=8443,
+        dest="webhook_port",
+        metavar="Port",
+        type=int,
+        help="Port on which the webhook listens",
+    )
+    parser.add_argument(
+        "--cache-db",
+        action="store",
+        dest="cache_path",
+        metavar="Path",
+        type=Path,
+        help="SQLite database in which to cache Instagram data, shared by all bot instances using it",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        action="store",
+        dest="memory_budget",
+        metavar="MiB",
+        type=float,
+        help="Memory the in-process caches may use together before evicting entries",
+    )
+    parser.add_argument(
+        "--warm",
+        action="store",
+        dest="warm_path",
+        metavar="Path",
+        type=Path,
+        help="List of @usernames and shortcodes whose profiles, latest posts and posts are prefetched at startup",
+    )
+    corpus = parser.add_mutually_exclusive_group()
+    corpus.add_argument(
+        "--record",
+        action="store",
+        dest="record_path",
+        metavar="Path",
+        type=Path,
+        help="Records the scrubbed Instagram responses of lookups to a gzipped corpus",
+    )
+    corpus.add_argument(
+        "--replay",
+        action="store",
+        dest="replay_path",
+        metavar="Path",
+        type=Path,
+        help="Answers lookups from a recorded corpus with its latencies, without Instagram",
+    )
     parser.add_argument(
         "--no-rich",
         action="store_false",
@@ -103,6 +328,21 @@ def main() -> None:
         dest="logfile",
         help="Output to log file",
     )
+    parser.add_argument(
+        "--log-json",
+        action="store_true",
+        dest="log_json",
+        help="Output structured JSON logs to the console",
+    )
+    parser.add_argument(
+        "--log-sample-rate",
+        action="store",
+        default=0.0,
+        dest="log_sample_rate",
+        metavar="Rate",
+        type=float,
+        help="Fraction of requests whose full payloads are logged (always logged when debugging)",
+    )
     parser.add_argument(
         "-d",
         "--debug",
@@ -112,25 +352,31 @@ def main() -> None:
     args = parser.parse_args()
 
     logging_handlers: List[logging.Handler] = []
+    json_logging_handlers: List[logging.Handler] = []
     do_rich = False
-    if args.rich:
+    if args.log_json:
+        json_logging_handlers.append(logging.StreamHandler())
+    elif args.rich:
         try:
             from rich.logging import RichHandler
         except ImportError:
             logging_handlers.append(logging.StreamHandler())
         else:
-            logging_handlers.append(RichHandler(rich_tracebacks=True))
+            rich_handler = RichHandler(rich_tracebacks=True)
+            rich_handler.setFormatter(PayloadFormatter("%(message)s"))
+            logging_handlers.append(rich_handler)
             do_rich = True
     else:
         logging_handlers.append(logging.StreamHandler())
 
     if args.logfile:
-        logging_handlers.append(logging.FileHandler("IgTgBot.log"))
+        json_logging_handlers.append(logging.FileHandler("IgTgBot.log"))
 
-    logging.basicConfig(
+    log_listener = configure_logging(
+        logging_handlers,
         level=logging.DEBUG if args.debug else logging.INFO,
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        handlers=logging_handlers,
+        json_handlers=json_logging_handlers,
+        payload_sample_rate=args.log_sample_rate,
     )
 
     logging.info(args)
@@ -145,11 +391,28 @@ def main() -> None:
         user_whitelist = set(args.whitelist)
         logging.info("Authorized users: %s", user_whitelist)
 
-    bot(
-        os.environ.get("TG_TOKEN") if "TG_TOKEN" in os.environ else args.token,
-        args.ig_user,
-        user_whitelist,
-    )
+    try:
+        bot(
+            os.environ.get("TG_TOKEN") if "TG_TOKEN" in os.environ else args.token,
+            args.ig_user,
+            user_whitelist,
+            None if args.user_rate is None else args.user_rate / 60,
+            args.user_burst,
+            args.workers,
+            args.webhook_url,
+            args.webhook_port,
+            args.cache_path,
+            args.concurrency,
+            None if args.admins is None else set(args.admins),
+            (None if args.memory_budget is None else int(args.memory_budget * 2**20)),
+            args.record_path,
+            args.replay_path,
+            args.max_queue_depth,
+            args.metrics_port,
+            args.warm_path,
+        )
+    finally:
+        log_listener.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+import logging
+import time
+from enum import Enum
+from exceptions import CircuitOpen
+
+
+def is_throttling(error: BaseException) -> bool:
+    """Returns whether an exception means Instagram is throttling us"""
+    from instagrapi import exceptions
+
+    return isinstance(
+        error,
+        (
+            exceptions.PleaseWaitFewMinutes,
+            exceptions.FeedbackRequired,
+            exceptions.RateLimitError,
+            exceptions.ClientThrottledError,
+            exceptions.SentryBlock,
+        ),
+    )
+
+
+class BreakerState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    """
+    Stops calls to Instagram once it starts throttling us.
+    After a cooldown a single probe is let through; if it is throttled too,
+    the cooldown doubles, up to max_cooldown.
+    """
+
+    base_cooldown: float
+    max_cooldown: float
+    state: BreakerState
+    cooldown: float
+    opened_at: float
+    _probing: bool
+
+    def __init__(
+        self, base_cooldown: float = 60, max_cooldown: float = 60 * 60
+    ) -> None:
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self.state = BreakerState.CLOSED
+        self.cooldown = base_cooldown
+        self.opened_at = 0.0
+        self._probing = False
+
+    def retry_after(self) -> float:
+        """Returns how many seconds remain until calls are allowed again"""
+        if self.state is BreakerState.CLOSED:
+            return 0.0
+        return max(0.0, self.opened_at + self.cooldown - time.monotonic())
+
+    def check(self) -> None:
+        """Fails fast while the breaker is open"""
+        retry_after = self.retry_after()
+        if retry_after > 0:
+            raise CircuitOpen(retry_after)
+
+    def before_call(self) -> bool:
+        """
+        Claims permission for a call, letting a single probe through once cooled down.
+        Returns whether the call is that probe.
+        """
+        self.check()
+        if self.state is BreakerState.CLOSED:
+            return False
+        if self._probing:
+            raise CircuitOpen(self.cooldown)
+        self.state = BreakerState.HALF_OPEN
+        self._probing = True
+        return True
+
+    def abandon_probe(self) -> None:
+        """Lets another probe through after one was cancelled before it was answered"""
+        self._probing = False
+
+    def record_success(self) -> None:
+        if self.state is not BreakerState.CLOSED:
+            logging.info("Instagram circuit breaker closed")
+        self.state = BreakerState.CLOSED
+        self.cooldown = self.base_cooldown
+        self._probing = False
+
+    def record_failure(self, error: BaseException) -> None:
+        if not is_throttling(error):
+            # Instagram answered, so it is reachable
+            self.record_success()
+            return
+        if self.state is BreakerState.HALF_OPEN:
+            self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+        self.state = BreakerState.OPEN
+        self.opened_at = time.monotonic()
+        self._probing = False
+        logging.warning(
+            "Instagram circuit breaker opened for %.0f s: %r", self.cooldown, error
+        )
+
+    def status(self) -> str:
+        if self.state is not BreakerState.OPEN:
+            return self.state.value
+        return f"{self.state.value}, retry in {self.retry_after():.0f} s"
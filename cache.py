@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+import pickle
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Generic, Hashable, List, Optional, Tuple, TypeVar
+
+from structures import deep_sizeof
+
+V = TypeVar("V")
+
+# Entries a memory cache keeps without a byte budget
+MAX_ENTRIES = 4096
+# With one the budget evicts long before, this is only a backstop
+BUDGETED_MAX_ENTRIES = 2**20
+
+
+class MemoryBudget:
+    """
+    Byte budget shared by several caches.
+    Once their entries together take more, the least recently used entry
+    among all of them is evicted, until they fit again.
+    Entry sizes are estimated with deep_sizeof when they are stored.
+    """
+
+    max_bytes: int
+    used: int
+    _caches: List["TTLCache[Any]"]
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.used = 0
+        self._caches = []
+
+    def register(self, cache: "TTLCache[Any]") -> None:
+        self._caches.append(cache)
+
+    def enforce(self) -> None:
+        while self.used > self.max_bytes:
+            candidates = [cache for cache in self._caches if len(cache) > 0]
+            if len(candidates) == 0:
+                return
+            min(candidates, key=lambda cache: cache.oldest_access()).evict_oldest()
+
+    def status(self) -> str:
+        entries = sum(len(cache) for cache in self._caches)
+        return (
+            f"{self.used / 2**20:.1f} of {self.max_bytes / 2**20:.1f} MiB"
+            f" in {entries} cached entries"
+        )
+
+
+class TTLCache(Generic[V]):
+    """
+    Least recently used cache whose entries each expire after their own TTL.
+    Expired entries are kept until evicted so they can still be served stale.
+    With a MemoryBudget, entries are also evicted to keep within it.
+    """
+
+    max_entries: int
+    budget: Optional[MemoryBudget]
+    # Entries are (expires, value, size, last accessed)
+    _entries: "OrderedDict[Hashable, Tuple[float, V, int, float]]"
+
+    def __init__(
+        self, max_entries: int = 1024, budget: Optional[MemoryBudget] = None
+    ) -> None:
+        self.max_entries = max_entries
+        self.budget = budget
+        self._entries = OrderedDict()
+        if budget is not None:
+            budget.register(self)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _touch(self, key: Hashable) -> None:
+        expires, value, size, _ = self._entries[key]
+        self._entries[key] = (expires, value, size, time.monotonic())
+        self._entries.move_to_end(key)
+
+    def get(self, key: Hashable) -> Optional[V]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            return None
+        self._touch(key)
+        return entry[1]
+
+    def get_stale(self, key: Hashable) -> Optional[V]:
+        """Returns an entry even if it has expired, as long as it wasn't evicted"""
+        entry = self._entries.get(key)
+        return None if entry is None else entry[1]
+
+    def ttl(self, key: Hashable) -> Optional[float]:
+        """Returns the seconds until an entry expires, None if it isn't stored"""
+        entry = self._entries.get(key)
+        return None if entry is None else entry[0] - time.monotonic()
+
+    def set(self, key: Hashable, value: V, ttl: float) -> None:
+        self.pop(key)
+        size = 0
+        if self.budget is not None:
+            size = deep_sizeof(key) + deep_sizeof(value)
+            self.budget.used += size
+        now = time.monotonic()
+        self._entries[key] = (now + ttl, value, size, now)
+        while len(self._entries) > self.max_entries:
+            self.evict_oldest()
+        if self.budget is not None:
+            self.budget.enforce()
+
+    def pop(self, key: Hashable) -> Optional[V]:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        if self.budget is not None:
+            self.budget.used -= entry[2]
+        return entry[1]
+
+    def oldest_access(self) -> float:
+        return next(iter(self._entries.values()))[3]
+
+    def evict_oldest(self) -> None:
+        self.pop(next(iter(self._entries)))
+
+
+class CacheBackend(ABC):
+    """
+    Storage for the metadata and file_id caches.
+    Also holds in-flight markers, so that only one bot instance fetches a given key.
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[Any]:
+        """Returns an entry that has not expired yet"""
+
+    @abstractmethod
+    def get_stale(self, key: str) -> Optional[Any]:
+        """Returns an entry even if it has expired, as long as it is still stored"""
+
+    @abstractmethod
+    def ttl(self, key: str) -> Optional[float]:
+        """Returns the seconds until an entry expires, None if it isn't stored"""
+
+    @abstractmethod
+    def set(self, key: str, value: Any, ttl: float) -> None: ...
+
+    @abstractmethod
+    def delete(self, key: str) -> None: ...
+
+    @abstractmethod
+    def try_lock(self, key: str, ttl: float) -> bool:
+        """Marks a key as being fetched, returns False if someone else already is"""
+
+    @abstractmethod
+    def unlock(self, key: str) -> None: ...
+
+    def close(self) -> None:
+        return
+
+
+class MemoryCacheBackend(CacheBackend):
+    """Cache private to this process"""
+
+    _entries: TTLCache[Any]
+    _locks: Dict[str, float]
+
+    def __init__(
+        self, max_entries: Optional[int] = None, budget: Optional[MemoryBudget] = None
+    ) -> None:
+        if max_entries is None:
+            max_entries = MAX_ENTRIES if budget is None else BUDGETED_MAX_ENTRIES
+        self._entries = TTLCache(max_entries, budget)
+        self._locks = {}
+
+    def get(self, key: str) -> Optional[Any]:
+        return self._entries.get(key)
+
+    def get_stale(self, key: str) -> Optional[Any]:
+        return self._entries.get_stale(key)
+
+    def ttl(self, key: str) -> Optional[float]:
+        return self._entries.ttl(key)
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        self._entries.set(key, value, ttl)
+
+    def delete(self, key: str) -> None:
+        self._entries.pop(key)
+
+    def try_lock(self, key: str, ttl: float) -> bool:
+        now = time.monotonic()
+        if self._locks.get(key, 0.0) > now:
+            return False
+        self._locks[key] = now + ttl
+        return True
+
+    def unlock(self, key: str) -> None:
+        self._locks.pop(key, None)
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """
+    Cache in an SQLite database in WAL mode,
+    which every bot instance with access to the file shares.
+    Expired entries are kept for `stale_retention` seconds so they can be served stale.
+    """
+
+    path: Path
+    stale_retention: float
+    _connection: sqlite3.Connection
+
+    def __init__(self, path: Path, stale_retention: float = 24 * 60 * 60) -> None:
+        self.path = path
+        self.stale_retention = stale_retention
+        self._connection = sqlite3.connect(path, timeout=5, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries"
+            " (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS inflight"
+            " (key TEXT PRIMARY KEY, expires REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "DELETE FROM entries WHERE expires < ?",
+            (time.time() - self.stale_retention,),
+        )
+
+    def _get(self, key: str, stale: bool) -> Optional[Any]:
+        row = self._connection.execute(
+            "SELECT value, expires FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or (not stale and row[1] <= time.time()):
+            return None
+        return pickle.loads(row[0])
+
+    def get(self, key: str) -> Optional[Any]:
+        return self._get(key, stale=False)
+
+    def get_stale(self, key: str) -> Optional[Any]:
+        return self._get(key, stale=True)
+
+    def ttl(self, key: str) -> Optional[float]:
+        row = self._connection.execute(
+            "SELECT expires FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        return None if row is None else row[0] - time.time()
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        self._connection.execute(
+            "INSERT OR REPLACE INTO entries (key, value, expires) VALUES (?, ?, ?)",
+            (key, pickle.dumps(value), time.time() + ttl),
+        )
+
+    def delete(self, key: str) -> None:
+        self._connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def try_lock(self, key: str, ttl: float) -> bool:
+        now = time.time()
+        self._connection.execute(
+            "DELETE FROM inflight WHERE key = ? AND expires <= ?", (key, now)
+        )
+        cursor = self._connection.execute(
+            "INSERT OR IGNORE INTO inflight (key, expires) VALUES (?, ?)",
+            (key, now + ttl),
+        )
+        return cursor.rowcount == 1
+
+    def unlock(self, key: str) -> None:
+        self._connection.execute("DELETE FROM inflight WHERE key = ?", (key,))
+
+    def close(self) -> None:
+        self._connection.close()
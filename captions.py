@@ -1,13 +1,17 @@
 #!/usr/bin/env python3
-from typing import Dict, Optional, Set
+from __future__ import annotations
 
-from instagrapi.types import Media, Story, User
-from telegram.constants import MessageEntityType
+from typing import TYPE_CHECKING, Dict, Optional, Sequence, Set
+
+from telegram.constants import MessageEntityType, MessageLimit
 
 from caption_functions import caption_hashtags, caption_mentions
 from formatted_text import FormattedText, shorten_formatted_text
 from structures import find_occurrences, utf16len
 
+if TYPE_CHECKING:
+    from records import CommentPage, MediaRecord, ProfileRecord, StoryRecord, UserRef
+
 emojis: Dict[str, str] = {
     "person": "👤",
     "location": "📍",
@@ -19,9 +23,9 @@ emojis: Dict[str, str] = {
 
 
 class MediaCaptions:
-    _media: Media
+    _media: MediaRecord
 
-    def __init__(self, media: Media) -> None:
+    def __init__(self, media: MediaRecord) -> None:
         self._media = media
 
     def long_caption(
@@ -83,11 +87,11 @@ class MediaCaptions:
             for tagged_user in self._media.usertags:
                 formatted_text.append(" ")
                 formatted_text.append(
-                    f"@{tagged_user.user.username}",
+                    f"@{tagged_user.username}",
                     type=MessageEntityType.TEXT_LINK,
-                    url=f"https://instagram.com/{tagged_user.user.username}",
+                    url=f"https://instagram.com/{tagged_user.username}",
                 )
-                formatted_text.append(f" ({tagged_user.user.pk})")
+                formatted_text.append(f" ({tagged_user.pk})")
             formatted_text.append("\n")
 
         # Location
@@ -176,9 +180,9 @@ class MediaCaptions:
 
 
 class StoryCaptions:
-    _story: Story
+    _story: StoryRecord
 
-    def __init__(self, story: Story) -> None:
+    def __init__(self, story: StoryRecord) -> None:
         self._story = story
 
     def long_caption(self) -> FormattedText:
@@ -217,9 +221,9 @@ class StoryCaptions:
             if i != 0:
                 formatted_text.append(" ")
             formatted_text.append(
-                f"#{mention.user.username}",
+                f"#{mention.username}",
                 type=MessageEntityType.TEXT_LINK,
-                url=f"https://instagram.com/{mention.user.username}",
+                url=f"https://instagram.com/{mention.username}",
             )
         if len(self._story.mentions) != 0:
             formatted_text.append("\n")
@@ -229,9 +233,9 @@ class StoryCaptions:
             if i != 0:
                 formatted_text.append(" ")
             formatted_text.append(
-                f"#{hashtag.hashtag.name}",
+                f"#{hashtag}",
                 type=MessageEntityType.TEXT_LINK,
-                url=f"https://instagram.com/explore/tags/{hashtag.hashtag.name}",
+                url=f"https://instagram.com/explore/tags/{hashtag}",
             )
         if len(self._story.hashtags) != 0:
             formatted_text.append("\n")
@@ -243,9 +247,9 @@ class StoryCaptions:
 
 
 class UserCaptions:
-    user: User
+    user: ProfileRecord
 
-    def __init__(self, user: User) -> None:
+    def __init__(self, user: ProfileRecord) -> None:
         self.user = user
 
     def long_caption(self) -> FormattedText:
@@ -364,3 +368,72 @@ class UserCaptions:
 
     def short_caption(self) -> FormattedText:
         return shorten_formatted_text(self.long_caption())
+
+
+class CommentPageCaptions:
+    _page: CommentPage
+    _number: int
+
+    def __init__(self, page: CommentPage, number: int) -> None:
+        self._page = page
+        self._number = number
+
+    def long_caption(self) -> FormattedText:
+        """Create a FormattedText object from a page of comments"""
+        formatted_text = FormattedText()
+        formatted_text.append(
+            f"{emojis['comments']}Comments, page {self._number + 1}\n"
+        )
+        if len(self._page.comments) == 0:
+            formatted_text.append("No comments\n")
+
+        for comment in self._page.comments:
+            formatted_text.append(
+                f"@{comment.user.username}",
+                type=MessageEntityType.TEXT_LINK,
+                url=f"https://instagram.com/{comment.user.username}",
+            )
+            formatted_text.append(f": {comment.text}")
+            if comment.like_count:
+                formatted_text.append(f" {emojis['heart']}{comment.like_count}")
+            formatted_text.append("\n")
+
+        return formatted_text
+
+    def short_caption(self) -> FormattedText:
+        return shorten_formatted_text(self.long_caption(), MessageLimit.MAX_TEXT_LENGTH)
+
+
+class LikersCaptions:
+    _likers: Sequence[UserRef]
+    _start: int
+    _total: int
+
+    def __init__(self, likers: Sequence[UserRef], start: int, total: int) -> None:
+        self._likers = likers
+        self._start = start
+        self._total = total
+
+    def long_caption(self) -> FormattedText:
+        """Create a FormattedText object from a page of the accounts that liked a post"""
+        formatted_text = FormattedText()
+        if self._total == 0:
+            formatted_text.append(f"{emojis['heart']}No likes\n")
+            return formatted_text
+        formatted_text.append(
+            f"{emojis['heart']}Liked by, {self._start + 1}-"
+            f"{self._start + len(self._likers)} of {self._total}\n"
+        )
+
+        for liker in self._likers:
+            formatted_text.append(
+                f"@{liker.username}",
+                type=MessageEntityType.TEXT_LINK,
+                url=f"https://instagram.com/{liker.username}",
+            )
+            formatted_text.append("\n")
+
+        return formatted_text
+
+    def short_caption(self) -> FormattedText:
+        return shorten_formatted_text(self.long_caption(), MessageLimit.MAX_TEXT_LENGTH)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+import time
+from typing import Any, Iterator, Optional
+from urllib.parse import parse_qs, urlsplit
+
+URL_FIELDS = ("video_url", "thumbnail_url", "profile_pic_url", "profile_pic_url_hd")
+
+# Refresh URLs a little before Instagram's CDN stops accepting them
+EXPIRY_MARGIN = 5 * 60
+
+
+def url_expiry(url: object) -> Optional[float]:
+    """Returns the Unix time at which a signed Instagram CDN URL expires, if it says"""
+    values = parse_qs(urlsplit(str(url)).query).get("oe")
+    if not values:
+        return None
+    try:
+        return float(int(values[0], 16))
+    except ValueError:
+        return None
+
+
+def record_urls(record: Any) -> Iterator[object]:
+    """Yields the CDN URLs held by a media, story or user record"""
+    for field in URL_FIELDS:
+        url = getattr(record, field, None)
+        if url is not None:
+            yield url
+    for resource in getattr(record, "resources", None) or []:
+        yield from record_urls(resource)
+
+
+def record_expiry(record: Any) -> Optional[float]:
+    """Returns when the first of a record's CDN URLs expires"""
+    return min(
+        (
+            expiry
+            for expiry in map(url_expiry, record_urls(record))
+            if expiry is not None
+        ),
+        default=None,
+    )
+
+
+def urls_valid(record: Any) -> bool:
+    expiry = record_expiry(record)
+    return expiry is None or expiry - EXPIRY_MARGIN > time.time()
+
+
+def expiry_ttl(record: Any, ttl: float) -> float:
+    """Shortens a TTL so that it ends before any of the record's URLs expire"""
+    expiry = record_expiry(record)
+    if expiry is None:
+        return ttl
+    return max(0.0, min(ttl, expiry - EXPIRY_MARGIN - time.time()))
+
+
+def copy_urls(target: Any, source: Any) -> None:
+    """Replaces the CDN URLs of a cached record with those of a newer copy"""
+    for field in URL_FIELDS:
+        if hasattr(target, field) and hasattr(source, field):
+            setattr(target, field, getattr(source, field))
+    for target_resource, source_resource in zip(
+        getattr(target, "resources", None) or [],
+        getattr(source, "resources", None) or [],
+    ):
+        copy_urls(target_resource, source_resource)
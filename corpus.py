@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+import asyncio
+import contextvars
+import gzip
+import json
+import logging
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, IO, List, Optional, TypeVar
+
+import requests
+from instagrapi import Client, exceptions
+
+T = TypeVar("T")
+
+# Fixes the endpoint selector's probing, so replays pick the same paths every run
+REPLAY_SEED = 0
+
+# Keys whose values belong to our session or device or identify someone,
+# dropped from both the recorded responses and the request parameters.
+# Dropping device IDs from the parameters also makes requests match across runs.
+_SCRUBBED_KEY = re.compile(
+    r"token|csrf|session|password|cookie|email|phone|viewer|friendship_status"
+    r"|uuid|device_id|guid",
+    re.IGNORECASE,
+)
+# Signed CDN URLs carry their expiry as hex Unix time
+_EXPIRY = re.compile(r"([?&]oe=)[0-9A-Fa-f]+")
+
+# The fetcher operation the current lookup belongs to, None outside lookups.
+# Logins and keepalives happen outside of them and are never recorded.
+operation: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "operation", default=None
+)
+
+
+def tagged(name: str, func: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+    """Wraps a lookup so the requests it makes are recorded under an operation"""
+
+    async def wrapper(*args: Any, **kwargs: Any) -> T:
+        token = operation.set(name)
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            operation.reset(token)
+
+    return wrapper
+
+
+def scrub(value: Any) -> Any:
+    """Returns a copy of a JSON value without session secrets and personal contacts"""
+    if isinstance(value, dict):
+        return {
+            key: scrub(item)
+            for key, item in value.items()
+            if not _SCRUBBED_KEY.search(str(key))
+        }
+    if isinstance(value, list):
+        return [scrub(item) for item in value]
+    return value
+
+
+def request_key(kind: str, url: str, params: Optional[Dict[str, Any]]) -> str:
+    """Identifies a request independently of the device and run it was made from"""
+    stable = json.dumps(scrub(params or {}), sort_keys=True, default=str)
+    return f"{kind} {url} {stable}"
+
+
+class Corpus:
+    """
+    Instagram responses recorded during lookups, as gzipped JSON lines.
+    Each entry holds the request, its scrubbed response or error, and its latency.
+    Entries are appended as they are recorded, so a killed bot loses at most
+    the last few, and a new run adds to the corpus of the previous one.
+    """
+
+    path: Path
+    entries: Dict[str, List[Dict[str, Any]]]
+    _served: Dict[str, int]
+    _file: Optional[IO[str]]
+    _lock: threading.Lock
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.entries = {}
+        self._served = {}
+        self._file = None
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        count = 0
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as file:
+                for line in file:
+                    entry = json.loads(line)
+                    self.entries.setdefault(entry["key"], []).append(entry)
+                    count += 1
+        except (EOFError, gzip.BadGzipFile, json.JSONDecodeError):
+            # The recording bot was killed while writing its last entry
+            logging.warning("Corpus %s is truncated after %s entries", self.path, count)
+        logging.info(
+            "Loaded %s responses to %s requests from %s",
+            count,
+            len(self.entries),
+            self.path,
+        )
+
+    def record(
+        self,
+        kind: str,
+        url: str,
+        params: Optional[Dict[str, Any]],
+        latency: float,
+        response: Any = None,
+        error: Optional[Exception] = None,
+        status: Optional[int] = None,
+        body: Any = None,
+    ) -> None:
+        name = operation.get()
+        if name is None:
+            return
+        entry: Dict[str, Any] = {
+            "key": request_key(kind, url, params),
+            "operation": name,
+            "latency": round(latency, 4),
+        }
+        if error is None:
+            entry["response"] = scrub(response)
+        else:
+            entry["error"] = {
+                "type": type(error).__name__,
+                "message": str(error),
+                "status": status,
+                "body": scrub(body),
+            }
+        line = json.dumps(entry, default=str, separators=(",", ":"))
+        with self._lock:
+            if self._file is None:
+                self._file = gzip.open(self.path, "at", encoding="utf-8")
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def next(self, kind: str, url: str, params: Optional[Dict[str, Any]]) -> Dict:
+        """
+        Returns the next recorded response to a request,
+        cycling through them when it was recorded more than once
+        """
+        key = request_key(kind, url, params)
+        entries = self.entries.get(key)
+        if not entries:
+            raise NotRecorded(f"No recorded response to {key}")
+        with self._lock:
+            index = self._served.get(key, 0)
+            self._served[key] = index + 1
+        return entries[index % len(entries)]
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class NotRecorded(exceptions.ClientError):
+    """A replayed request is missing from the corpus"""
+
+
+def _error_body(error: exceptions.ClientError) -> Any:
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return response.json()
+    except ValueError:
+        return response.text
+
+
+class RecordingClient(Client):
+    """
+    An instagrapi client that records the raw responses to the requests
+    made by the fetcher's lookups into a corpus
+    """
+
+    corpus: Corpus
+
+    def __init__(self, corpus: Corpus, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.corpus = corpus
+
+    def _send_private_request(self, endpoint, *args, **kwargs):
+        params = kwargs.get("params", args[1] if len(args) > 1 else None)
+        start = time.perf_counter()
+        try:
+            response = super()._send_private_request(endpoint, *args, **kwargs)
+        except exceptions.ClientError as e:
+            self.corpus.record(
+                "private",
+                endpoint,
+                params,
+                time.perf_counter() - start,
+                error=e,
+                status=getattr(getattr(e, "response", None), "status_code", None),
+                body=self.last_json,
+            )
+            raise
+        self.corpus.record(
+            "private", endpoint, params, time.perf_counter() - start, response
+        )
+        return response
+
+    def _send_public_request(self, url, *args, **kwargs):
+        params = kwargs.get("params", args[1] if len(args) > 1 else None)
+        start = time.perf_counter()
+        try:
+            response = super()._send_public_request(url, *args, **kwargs)
+        except exceptions.ClientError as e:
+            self.corpus.record(
+                "public",
+                url,
+                params,
+                time.perf_counter() - start,
+                error=e,
+                status=getattr(getattr(e, "response", None), "status_code", None),
+                body=_error_body(e),
+            )
+            raise
+        self.corpus.record("public", url, params, time.perf_counter() - start, response)
+        return response
+
+
+class ReplayClient(Client):
+    """
+    An instagrapi client that answers requests from a corpus instead of
+    Instagram, after the latency they were recorded with.
+    It needs no network and no login, so workloads replay identically.
+    """
+
+    corpus: Corpus
+
+    def __init__(self, corpus: Corpus, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.corpus = corpus
+
+    def _serve(
+        self, kind: str, entry: Dict[str, Any], keep_last_json: bool = True
+    ) -> Any:
+        error = entry.get("error")
+        if error is None:
+            # Recorded CDN URLs expire, replayed ones shouldn't be refreshed
+            response = json.loads(
+                _EXPIRY.sub(r"\1ffffffff", json.dumps(entry["response"]))
+            )
+            if kind == "private" and keep_last_json:
+                self.last_json = response
+            elif isinstance(response, dict):
+                self.last_public_json = response
+            return response
+
+        body = error["body"]
+        http_response = requests.Response()
+        http_response.status_code = error["status"] or 0
+        http_response._content = (
+            json.dumps(body) if isinstance(body, (dict, list)) else str(body or "")
+        ).encode()
+        if kind == "private" and keep_last_json:
+            self.last_json = body if isinstance(body, dict) else {}
+        error_type = getattr(exceptions, error["type"], exceptions.ClientError)
+        if not (
+            isinstance(error_type, type)
+            and issubclass(error_type, exceptions.ClientError)
+        ):
+            error_type = exceptions.ClientError
+        raise error_type(error["message"], response=http_response)
+
+    def _send_private_request(self, endpoint, *args, **kwargs):
+        params = kwargs.get("params", args[1] if len(args) > 1 else None)
+        entry = self.corpus.next("private", endpoint, params)
+        time.sleep(entry["latency"])
+        return self._serve("private", entry)
+
+    def _send_public_request(self, url, *args, **kwargs):
+        params = kwargs.get("params", args[1] if len(args) > 1 else None)
+        entry = self.corpus.next("public", url, params)
+        time.sleep(entry["latency"])
+        return self._serve("public", entry)
+
+    async def private_request_async(
+        self, endpoint: str, params: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """
+        Answers a request of the HTTP/2 transport, without blocking the event loop.
+        Like the transport, it leaves last_json to the calls running in a thread.
+        """
+        entry = self.corpus.next("private", endpoint, params)
+        await asyncio.sleep(entry["latency"])
+        return self._serve("private", entry, keep_last_json=False)
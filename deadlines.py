@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+import contextvars
+import time
+from typing import Optional
+
+from telegram import Update
+from telegram.ext import CallbackContext
+
+# Telegram drops an inline query's answer after about 10 seconds
+INLINE_DEADLINE = 8
+# A callback query's button keeps spinning until it is answered, for up to 15 seconds
+CALLBACK_DEADLINE = 12
+COMMAND_DEADLINE = 60
+
+# When the work for the current update is no longer of use, in monotonic time.
+# None outside of updates, e.g. for scheduled jobs, which have no deadline.
+deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar(
+    "deadline", default=None
+)
+
+
+def remaining() -> Optional[float]:
+    """Returns the seconds left until the current deadline, None if there is none"""
+    current = deadline.get()
+    if current is None:
+        return None
+    return max(0.0, current - time.monotonic())
+
+
+def clear() -> None:
+    """
+    Drops the deadline of the current context. Jobs run in a copy of the context
+    they were scheduled from, which may be the one of an update.
+    """
+    deadline.set(None)
+
+
+async def start(update: object, context: CallbackContext) -> None:
+    """
+    Runs before every other handler and sets the deadline of the update.
+    Later handlers run in the same context, or a copy of it, so they see it.
+    """
+    if not isinstance(update, Update):
+        return
+    if update.inline_query is not None:
+        seconds = INLINE_DEADLINE
+    elif update.callback_query is not None:
+        seconds = CALLBACK_DEADLINE
+    else:
+        seconds = COMMAND_DEADLINE
+    deadline.set(time.monotonic() + seconds)
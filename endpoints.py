@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+import logging
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from breaker import is_throttling
+
+# Weight of the newest sample in the latency moving average
+LATENCY_SMOOTHING = 0.3
+# A path that failed this many times in a row is only used as a last resort...
+FAILURE_THRESHOLD = 3
+# ...until this many seconds passed since its last failure
+FAILURE_COOLDOWN = 5 * 60
+# Fraction of calls that try a path other than the currently best one
+PROBE_RATE = 0.05
+
+
+def is_answer(error: BaseException) -> bool:
+    """Returns whether an exception is Instagram's answer rather than a failing path"""
+    from instagrapi import exceptions
+
+    return isinstance(error, (exceptions.NotFoundError, exceptions.PrivateAccount))
+
+
+class PathStats:
+    latency: Optional[float]
+    failures: int
+    last_failure: float
+    calls: int
+
+    def __init__(self) -> None:
+        self.latency = None
+        self.failures = 0
+        self.last_failure = 0.0
+        self.calls = 0
+
+    def is_healthy(self, now: float) -> bool:
+        return (
+            self.failures < FAILURE_THRESHOLD
+            or now - self.last_failure > FAILURE_COOLDOWN
+        )
+
+    def record(self, elapsed: float, failed: bool) -> None:
+        self.calls += 1
+        if failed:
+            self.failures += 1
+            self.last_failure = time.monotonic()
+            return
+        self.failures = 0
+        self.latency = (
+            elapsed
+            if self.latency is None
+            else LATENCY_SMOOTHING * elapsed + (1 - LATENCY_SMOOTHING) * self.latency
+        )
+
+
+class EndpointSelector:
+    """
+    Picks between the ways instagrapi can perform an operation
+    (e.g. the public GraphQL and the private API), preferring the healthy path
+    with the lowest recent latency, falling back on errors,
+    and now and then probing other paths so their statistics stay current.
+    """
+
+    _stats: Dict[Tuple[str, str], PathStats]
+    _lock: threading.Lock
+
+    def __init__(self) -> None:
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _path_stats(self, operation: str, path: str) -> PathStats:
+        key = (operation, path)
+        if key not in self._stats:
+            self._stats[key] = PathStats()
+        return self._stats[key]
+
+    def order(self, operation: str, paths: Sequence[str]) -> List[str]:
+        """Returns the paths of an operation in the order they should be tried"""
+        now = time.monotonic()
+        with self._lock:
+            stats = {path: self._path_stats(operation, path) for path in paths}
+        # Unmeasured paths sort first so that each gets measured
+        ordered = sorted(
+            paths,
+            key=lambda path: (
+                not stats[path].is_healthy(now),
+                -1.0 if stats[path].latency is None else stats[path].latency,
+            ),
+        )
+        if len(ordered) > 1 and random.random() < PROBE_RATE:
+            probe = random.randrange(1, len(ordered))
+            ordered.insert(0, ordered.pop(probe))
+        return ordered
+
+    def _record(
+        self, operation: str, path: str, start: float, error: Optional[Exception]
+    ) -> None:
+        # Another path may still succeed, e.g. the private API for
+        # media the public one won't show, so answers fall back as well
+        with self._lock:
+            self._path_stats(operation, path).record(
+                time.perf_counter() - start,
+                failed=error is not None and not is_answer(error),
+            )
+        if error is not None:
+            logging.info("%s through %s failed: %r", operation, path, error)
+
+    async def call(
+        self, operation: str, paths: Dict[str, Callable[[], Awaitable[Any]]]
+    ) -> Any:
+        """
+        Performs an operation through the best path, falling back to the others.
+        Throttling is raised at once, as the other paths would only make it worse.
+        """
+        error: Optional[Exception] = None
+        for path in self.order(operation, list(paths)):
+            start = time.perf_counter()
+            try:
+                result = await paths[path]()
+            except Exception as e:
+                self._record(operation, path, start, e)
+                if is_throttling(e):
+                    raise
+                error = e
+                continue
+            self._record(operation, path, start, None)
+            return result
+        if error is None:
+            raise ValueError("Expected at least one path.")
+        raise error
+
+    def status(self) -> List[str]:
+        with self._lock:
+            return [
+                f"{operation} via {path}: "
+                + ("unmeasured" if stats.latency is None else f"{stats.latency:.2f} s")
+                + f", {stats.failures} failures in a row, {stats.calls} calls"
+                for (operation, path), stats in sorted(self._stats.items())
+            ]
@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
+import logging
 from types import TracebackType
 from typing import Optional, Set, Type
 from uuid import uuid4
 
 from telegram import InlineQueryResultArticle, InputTextMessageContent, Update
+from telegram.constants import CallbackQueryLimit
 from telegram.ext import CallbackContext
 
+from exceptions import Busy, DeadlineExceeded
+
 
 class ErrorHandler:
     whitelist: Optional[Set[int]]
@@ -46,9 +50,25 @@ class ErrorHandler:
             ):
                 await update.message.reply_text(exception_sting, quote=True)
 
-            if (update.inline_query is not None) and (
+            if (update.callback_query is not None) and (
                 (self.whitelist is None)
-                or (update.inline_query.from_user.id in self.whitelist)
+                or (update.callback_query.from_user.id in self.whitelist)
+            ):
+                await update.callback_query.answer(
+                    exception_sting[
+                        : CallbackQueryLimit.ANSWER_CALLBACK_QUERY_TEXT_LENGTH
+                    ],
+                    show_alert=True,
+                )
+
+            if (
+                (update.inline_query is not None)
+                # Telegram no longer accepts answers to queries past their deadline
+                and not isinstance(context.error, DeadlineExceeded)
+                and (
+                    (self.whitelist is None)
+                    or (update.inline_query.from_user.id in self.whitelist)
+                )
             ):
                 await update.inline_query.answer(
                     [
@@ -61,8 +81,14 @@ class ErrorHandler:
                             ),
                         )
                     ],
-                    cache_time=300,
+                    # Being busy passes, so it isn't cached like other errors
+                    cache_time=0 if isinstance(context.error, Busy) else 300,
                     is_personal=True,
                 )
 
+        if isinstance(context.error, Busy):
+            # Shedding requests is expected under load, not a bug
+            logging.info("Shed an update: %s", context.error)
+            return
+
         raise context.error
@@ -1,3 +1,32 @@
 #!/usr/bin/env python3
 class InvalidMessageEntity(Exception):
     """Exception raised when one attempts to add an invalid entity to FormattedText"""
+
+
+class CircuitOpen(Exception):
+    """Exception raised when Instagram lookups are paused because Instagram is throttling us"""
+
+    retry_after: float
+
+    def __init__(self, retry_after: float) -> None:
+        super().__init__(
+            f"Instagram is limiting requests, try again in {retry_after:.0f} s"
+        )
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    """Exception raised when an update's work ran past its deadline without a cached answer"""
+
+    def __init__(self) -> None:
+        super().__init__("Instagram took too long to answer, try again later")
+
+
+class Busy(Exception):
+    """Exception raised when a lookup is shed because too many are already waiting"""
+
+    depth: int
+
+    def __init__(self, depth: int) -> None:
+        super().__init__(f"Busy with {depth} waiting requests, please retry shortly")
+        self.depth = depth
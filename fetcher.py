@@ -0,0 +1,617 @@
+#!/usr/bin/env python3
+import asyncio
+import logging
+import random
+from collections import Counter
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Awaitable,
+    Callable,
+    Counter as CounterType,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+)
+
+from telegram.ext import Application
+
+import deadlines
+from breaker import CircuitBreaker
+from cache import CacheBackend, MemoryBudget, MemoryCacheBackend, TTLCache
+from cdn import copy_urls, urls_valid
+from endpoints import EndpointSelector
+from exceptions import Busy, CircuitOpen, DeadlineExceeded
+from records import (
+    CommentPage,
+    CommentRecord,
+    MediaRecord,
+    ProfileRecord,
+    StoryRecord,
+    UserRef,
+    slim,
+)
+from scheduler import FairScheduler, Priority
+from startup import startup_report
+from transport import AsyncInstagramTransport
+
+if TYPE_CHECKING:
+    from instagrapi import Client
+    from instagrapi.types import Media, Story, User
+
+    from corpus import Corpus
+    from session import SessionManager
+
+T = TypeVar("T")
+
+# How long captions are kept, CDN URLs are refreshed separately once they expire
+METADATA_TTL = 6 * 60 * 60
+NOT_FOUND_TTL = 5 * 60
+PRIVATE_TTL = 5 * 60
+LOGIN_REQUIRED_TTL = 60
+IN_FLIGHT_TTL = 30
+IN_FLIGHT_POLL_INTERVAL = 0.25
+# Lookups that may wait in the scheduler before new ones are shed
+MAX_QUEUE_DEPTH = 100
+COMMENTS_PAGE_SIZE = 20
+# Creating the session is retried after this long, doubling up to the maximum
+SESSION_RETRY_DELAY = 30
+SESSION_RETRY_MAX_DELAY = 30 * 60
+
+
+def negative_ttl(error: Exception) -> Optional[float]:
+    """Returns how long a failed lookup should be remembered, None if it shouldn't be"""
+    from instagrapi import exceptions
+
+    if isinstance(
+        error,
+        (
+            exceptions.NotFoundError,
+            exceptions.ClientNotFoundError,
+            exceptions.MediaUnavailable,
+            exceptions.InvalidMediaId,
+            exceptions.InvalidTargetUser,
+        ),
+    ):
+        return NOT_FOUND_TTL
+    if isinstance(error, exceptions.PrivateAccount):
+        return PRIVATE_TTL
+    if isinstance(
+        error,
+        (
+            exceptions.LoginRequired,
+            exceptions.ClientLoginRequired,
+            exceptions.ClientUnauthorizedError,
+        ),
+    ):
+        return LOGIN_REQUIRED_TTL
+    return None
+
+
+def public_call(client: "Client", func: Callable[[], T]) -> T:
+    """
+    Calls a public API method, retrying with the session's cookies if it needs a login,
+    as instagrapi does itself
+    """
+    from instagrapi.exceptions import ClientLoginRequired
+
+    try:
+        return func()
+    except ClientLoginRequired:
+        if not client.inject_sessionid_to_public():
+            raise
+        return func()
+
+
+def story_info_uncached(client: "Client", story_pk: str) -> "Story":
+    """
+    Looks a story up through its user's whole reel, then empties instagrapi's own
+    story cache, which keeps every story of every reel seen and is never evicted
+    """
+    try:
+        return client.story_info_v1(story_pk)
+    finally:
+        client._stories_cache.clear()
+
+
+class InstagramFetcher:
+    """
+    The layer through which all Instagram lookups go.
+    Lookups are queued per priority class and Telegram user,
+    and run against the shared session.
+    """
+
+    scheduler: FairScheduler
+    breaker: CircuitBreaker
+    endpoints: EndpointSelector
+    cache: CacheBackend
+    transport: AsyncInstagramTransport
+    # The class and arguments of each failure, so every hit raises a fresh exception
+    failures: TTLCache[Tuple[Type[Exception], Tuple[Any, ...]]]
+    timeouts: CounterType[str]
+    _ig_user: Optional[str]
+    _session_path: Optional[Path]
+    _delay_range: List[int]
+    _session: Optional["SessionManager"]
+    _session_error: Optional[BaseException]
+    _ready: asyncio.Event
+    _record_path: Optional[Path]
+    _replay_path: Optional[Path]
+    _corpus: Optional["Corpus"]
+
+    def __init__(
+        self,
+        ig_user: Optional[str],
+        delay_range: Optional[List[int]] = None,
+        concurrency: int = 1,
+        user_rate: Optional[float] = None,
+        user_burst: float = 5,
+        session_path: Optional[Path] = None,
+        cache: Optional[CacheBackend] = None,
+        budget: Optional[MemoryBudget] = None,
+        record_path: Optional[Path] = None,
+        replay_path: Optional[Path] = None,
+        max_queue_depth: Optional[int] = MAX_QUEUE_DEPTH,
+    ) -> None:
+        self._session_path = session_path
+        self.scheduler = FairScheduler(
+            concurrency, user_rate, user_burst, max_depth=max_queue_depth
+        )
+        self.breaker = CircuitBreaker()
+        self.endpoints = EndpointSelector()
+        self.cache = MemoryCacheBackend() if cache is None else cache
+        self.transport = AsyncInstagramTransport()
+        self.failures = TTLCache(budget=budget)
+        self.timeouts = Counter()
+        self._ig_user = ig_user
+        self._delay_range = [1, 3] if delay_range is None else delay_range
+        self._session = None
+        self._session_error = None
+        self._ready = asyncio.Event()
+        self._record_path = record_path
+        self._replay_path = replay_path
+        self._corpus = None
+
+    def _create_session(self) -> "SessionManager":
+        """Imports instagrapi, then logs in and validates the session"""
+        instagrapi = startup_report.timed_import("instagrapi")
+        login = startup_report.timed_import("login")
+        session = startup_report.timed_import("session")
+
+        session_path = (
+            login.SESSION_PATH if self._session_path is None else self._session_path
+        )
+
+        if self._replay_path is not None:
+            corpus = startup_report.timed_import("corpus")
+            self._corpus = corpus.Corpus(self._replay_path)
+            self._corpus.load()
+            random.seed(corpus.REPLAY_SEED)
+            # The recorded latencies stand in for both the network and the delays
+            return session.SessionManager(
+                corpus.ReplayClient(self._corpus), None, session_path
+            )
+
+        if self._record_path is not None:
+            corpus = startup_report.timed_import("corpus")
+            self._corpus = corpus.Corpus(self._record_path)
+            client = corpus.RecordingClient(self._corpus)
+        else:
+            client = instagrapi.Client()
+
+        if self._ig_user is not None:
+            login.login_user(client, self._ig_user, session_path)
+
+        client.delay_range = self._delay_range
+        return session.SessionManager(client, self._ig_user, session_path)
+
+    async def _start_session(self, application: Application) -> None:
+        """
+        Creates the Instagram client, retrying with a growing delay if it fails.
+        Meanwhile lookups fail with the last error instead of waiting.
+        """
+        delay = SESSION_RETRY_DELAY
+        while True:
+            try:
+                session = await asyncio.to_thread(self._create_session)
+            except Exception as e:
+                logging.exception(
+                    "Could not create Instagram client, retrying in %s s", delay
+                )
+                self._session_error = e
+            else:
+                self._session = session
+                self._session_error = None
+                application.create_task(session.keepalive())
+            if not self._ready.is_set():
+                startup_report.mark("Instagram session ready")
+                startup_report.log()
+                self._ready.set()
+            if self._session is not None:
+                return
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, SESSION_RETRY_MAX_DELAY)
+
+    async def start(self, application: Application) -> None:
+        """Creates the Instagram client in the background once the bot is polling"""
+        application.create_task(self._start_session(application))
+
+    async def stop(self) -> None:
+        await self.transport.close()
+        if self._corpus is not None:
+            self._corpus.close()
+
+    async def get_session(self) -> "SessionManager":
+        """Returns the Instagram session, waiting for it to be validated"""
+        await self._ready.wait()
+        if self._session_error is not None:
+            raise self._session_error
+        if self._session is None:
+            raise ValueError("Expected Instagram session to be created.")
+        return self._session
+
+    async def _before_deadline(self, awaitable: Awaitable[T]) -> T:
+        """
+        Awaits something within the deadline of the current update, if it has one.
+        Past the deadline it is cancelled, and so is the lookup it queued,
+        while one already running finishes in its scheduler slot.
+        """
+        return await asyncio.wait_for(awaitable, deadlines.remaining())
+
+    def _timed_out(self, key: str) -> None:
+        operation = key.partition(":")[0]
+        self.timeouts[operation] += 1
+        logging.info("Lookup of %s cancelled at its deadline", key)
+
+    async def _claim(self, key: str) -> Optional[Any]:
+        """
+        Marks a key as in flight. If another request or bot instance is already
+        fetching it, waits for and returns its result instead.
+        """
+        while not self.cache.try_lock(key, IN_FLIGHT_TTL):
+            await asyncio.sleep(IN_FLIGHT_POLL_INTERVAL)
+            record = self.cache.get(key)
+            if record is not None:
+                return record
+        return None
+
+    async def _fetch(
+        self,
+        key: str,
+        user_id: int,
+        func: Callable[["SessionManager"], Awaitable[Any]],
+        priority: Priority,
+        refresh: Callable[["SessionManager"], Awaitable[Any]],
+    ) -> Any:
+        """
+        Runs a lookup through the scheduler unless its result is cached.
+        Once the CDN URLs of a cached record expire, only they are replaced,
+        using the cheaper `refresh` lookup.
+        Lookups that recently failed for good reason fail again without going upstream,
+        and while Instagram is throttling us or too many lookups are waiting,
+        they fail fast, unless an expired record can be served.
+        Only one request across all bot instances sharing the cache fetches a key.
+        """
+        record = self.cache.get(key)
+        if record is not None:
+            if not urls_valid(record):
+                # Whatever fails, the record is served: expired URLs may still
+                # load from Telegram's or a client's cache
+                try:
+                    await self._refresh_urls(key, record, user_id, refresh, priority)
+                except asyncio.TimeoutError:
+                    self._timed_out(key)
+                except (CircuitOpen, Busy):
+                    pass
+                except Exception:
+                    logging.warning(
+                        "Could not refresh the URLs of %s", key, exc_info=True
+                    )
+            return record
+        failure = self.failures.get(key)
+        if failure is not None:
+            error_type, args = failure
+            raise error_type(*args)
+        try:
+            self.breaker.check()
+            record = await self._before_deadline(self._claim(key))
+            if record is not None:
+                return record
+            try:
+                session = await self._before_deadline(self.get_session())
+                record = await self._before_deadline(
+                    self.scheduler.submit(
+                        user_id, lambda: self._call(session, func, key), priority
+                    )
+                )
+            finally:
+                self.cache.unlock(key)
+        except (CircuitOpen, Busy):
+            # Serve an expired record rather than nothing
+            record = self.cache.get_stale(key)
+            if record is None:
+                raise
+            return record
+        except asyncio.TimeoutError:
+            self._timed_out(key)
+            record = self.cache.get_stale(key)
+            if record is None:
+                raise DeadlineExceeded() from None
+            return record
+        except Exception as e:
+            ttl = negative_ttl(e)
+            if ttl is not None:
+                self.failures.set(key, (type(e), e.args), ttl)
+            raise
+        self.cache.set(key, record, METADATA_TTL)
+        return record
+
+    async def _refresh_urls(
+        self,
+        key: str,
+        record: Any,
+        user_id: int,
+        refresh: Callable[["SessionManager"], Awaitable[Any]],
+        priority: Priority,
+    ) -> None:
+        self.breaker.check()
+        session = await self._before_deadline(self.get_session())
+        fresh = await self._before_deadline(
+            self.scheduler.submit(
+                user_id, lambda: self._call(session, refresh, key), priority
+            )
+        )
+        copy_urls(record, fresh)
+        # The rest of the record is as old as before, so it expires when it would have
+        ttl = self.cache.ttl(key)
+        if ttl is not None and ttl > 0:
+            self.cache.set(key, record, ttl)
+
+    async def _call(
+        self,
+        session: "SessionManager",
+        func: Callable[["SessionManager"], Awaitable[Any]],
+        key: str,
+    ) -> Any:
+        if self._corpus is not None:
+            from corpus import tagged
+
+            # Records the responses under the kind of lookup, e.g. media or username
+            func = tagged(key.partition(":")[0], func)
+        probe = self.breaker.before_call()
+        try:
+            result = await session.run(func, session)
+        except Exception as e:
+            self.breaker.record_failure(e)
+            raise
+        except BaseException:
+            # Cancelled, e.g. at shutdown, so the probe never got an answer
+            if probe:
+                self.breaker.abandon_probe()
+            raise
+        self.breaker.record_success()
+        return result
+
+    async def _media_info(self, session: "SessionManager", media_pk: str) -> "Media":
+        client = session.client
+        return await self.endpoints.call(
+            "media_info",
+            {
+                "gql": lambda: session.in_thread(
+                    public_call, client, lambda: client.media_info_gql(media_pk)
+                ),
+                "v1": lambda: session.in_thread(client.media_info_v1, media_pk),
+                "http2": lambda: self.transport.media_info(client, media_pk),
+            },
+        )
+
+    async def _user_info(self, session: "SessionManager", ig_user_id: str) -> "User":
+        client = session.client
+        return await self.endpoints.call(
+            "user_info",
+            {
+                "gql": lambda: session.in_thread(
+                    public_call, client, lambda: client.user_info_gql(ig_user_id)
+                ),
+                "v1": lambda: session.in_thread(client.user_info_v1, ig_user_id),
+                "http2": lambda: self.transport.user_info(client, ig_user_id),
+            },
+        )
+
+    async def _user_info_by_username(
+        self, session: "SessionManager", username: str
+    ) -> "User":
+        client = session.client
+        return await self.endpoints.call(
+            "user_info_by_username",
+            {
+                "gql": lambda: session.in_thread(
+                    public_call,
+                    client,
+                    lambda: client.user_info_by_username_gql(username),
+                ),
+                "v1": lambda: session.in_thread(
+                    client.user_info_by_username_v1, username
+                ),
+                "http2": lambda: self.transport.user_info_by_username(client, username),
+            },
+        )
+
+    async def _user_medias(
+        self, session: "SessionManager", ig_user_id: str, amount: int
+    ) -> List["Media"]:
+        client = session.client
+        page: Tuple[List["Media"], Any] = await self.endpoints.call(
+            "user_medias",
+            {
+                "gql": lambda: session.in_thread(
+                    public_call,
+                    client,
+                    lambda: client.user_medias_paginated_gql(
+                        ig_user_id, amount, sleep=0
+                    ),
+                ),
+                "v1": lambda: session.in_thread(
+                    client.user_medias_paginated_v1, ig_user_id, amount
+                ),
+            },
+        )
+        return page[0]
+
+    async def user_medias(
+        self,
+        user_id: int,
+        ig_user_id: str,
+        amount: int = 12,
+        priority: Priority = Priority.BULK,
+    ) -> List[MediaRecord]:
+        """
+        Returns the first page of an account's posts, newest first.
+        Pages are not cached, as they are only looked at to find new posts.
+        """
+
+        async def lookup(session: "SessionManager") -> List[MediaRecord]:
+            medias = await self._user_medias(session, ig_user_id, amount)
+            return [slim(MediaRecord.from_media, media) for media in medias]
+
+        self.breaker.check()
+        try:
+            session = await self._before_deadline(self.get_session())
+            records: List[MediaRecord] = await self._before_deadline(
+                self.scheduler.submit(
+                    user_id,
+                    lambda: self._call(session, lookup, "user_medias"),
+                    priority,
+                )
+            )
+        except asyncio.TimeoutError:
+            self._timed_out(f"user_medias:{ig_user_id}")
+            raise DeadlineExceeded() from None
+        for record in records:
+            self.cache.set(f"media:{record.code}", record, METADATA_TTL)
+        return records
+
+    async def media_info(
+        self, user_id: int, shortcode: str, priority: Priority = Priority.COMMAND
+    ) -> MediaRecord:
+        async def lookup(session: "SessionManager") -> MediaRecord:
+            client = session.client
+            media_pk = client.media_pk_from_code(shortcode)
+            return slim(
+                MediaRecord.from_media, await self._media_info(session, media_pk)
+            )
+
+        async def refresh(session: "SessionManager") -> MediaRecord:
+            client = session.client
+            media_pk = client.media_pk_from_code(shortcode)
+            return slim(
+                MediaRecord.from_media,
+                await self.transport.media_info(client, media_pk),
+            )
+
+        return await self._fetch(
+            f"media:{shortcode}", user_id, lookup, priority, refresh
+        )
+
+    async def story_info(
+        self, user_id: int, story_pk: int, priority: Priority = Priority.COMMAND
+    ) -> StoryRecord:
+        # Stories are looked up through a user's whole reel, which stays in the thread
+        async def lookup(session: "SessionManager") -> StoryRecord:
+            story = await session.in_thread(
+                story_info_uncached, session.client, str(story_pk)
+            )
+            return slim(StoryRecord.from_story, story)
+
+        # Stories have no cheaper lookup, so refreshing their URLs costs a full one
+        return await self._fetch(f"story:{story_pk}", user_id, lookup, priority, lookup)
+
+    async def media_comments(
+        self,
+        user_id: int,
+        media_id: str,
+        page: int,
+        priority: Priority = Priority.COMMAND,
+    ) -> CommentPage:
+        """
+        Returns a page of a post's comments, given its media ID ("{pk}_{user pk}").
+        Each page is cached with the cursor the next one starts from,
+        so only the requested page is fetched unless earlier ones were evicted.
+        """
+        cursor: Optional[str] = None
+        if page > 0:
+            cursor = (
+                await self.media_comments(user_id, media_id, page - 1, priority)
+            ).cursor
+            if cursor is None:
+                return CommentPage((), None)
+
+        async def lookup(session: "SessionManager") -> CommentPage:
+            comments, next_cursor = await session.in_thread(
+                session.client.media_comments_chunk,
+                media_id,
+                COMMENTS_PAGE_SIZE,
+                cursor,
+            )
+            return CommentPage(
+                tuple(map(CommentRecord.from_comment, comments)), next_cursor or None
+            )
+
+        # Comments hold no CDN URLs, so they never need refreshing
+        return await self._fetch(
+            f"comments:{media_id}:{page}", user_id, lookup, priority, lookup
+        )
+
+    async def media_likers(
+        self, user_id: int, media_id: str, priority: Priority = Priority.COMMAND
+    ) -> Tuple[UserRef, ...]:
+        """Returns the accounts that liked a post, which Instagram sends in one go"""
+
+        async def lookup(session: "SessionManager") -> Tuple[UserRef, ...]:
+            users = await session.in_thread(session.client.media_likers, media_id)
+            return tuple(map(UserRef.from_user_short, users))
+
+        return await self._fetch(
+            f"likers:{media_id}", user_id, lookup, priority, lookup
+        )
+
+    async def user_info(
+        self, user_id: int, ig_user_id: str, priority: Priority = Priority.COMMAND
+    ) -> ProfileRecord:
+        async def lookup(session: "SessionManager") -> ProfileRecord:
+            return slim(
+                ProfileRecord.from_user,
+                await self._user_info(session, ig_user_id),
+            )
+
+        async def refresh(session: "SessionManager") -> ProfileRecord:
+            return slim(
+                ProfileRecord.from_user,
+                await self.transport.user_info(session.client, ig_user_id),
+            )
+
+        return await self._fetch(
+            f"user:{ig_user_id}", user_id, lookup, priority, refresh
+        )
+
+    async def user_info_by_username(
+        self, user_id: int, username: str, priority: Priority = Priority.COMMAND
+    ) -> ProfileRecord:
+        async def lookup(session: "SessionManager") -> ProfileRecord:
+            return slim(
+                ProfileRecord.from_user,
+                await self._user_info_by_username(session, username),
+            )
+
+        async def refresh(session: "SessionManager") -> ProfileRecord:
+            return slim(
+                ProfileRecord.from_user,
+                await self.transport.user_info_by_username(session.client, username),
+            )
+
+        return await self._fetch(
+            f"username:{username.lower()}", user_id, lookup, priority, refresh
+        )
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 
-from typing import List, Optional, Union, overload
+from typing import Iterator, List, Optional, Tuple, Union, overload
 
 from telegram import MessageEntity, User
 from telegram.constants import MessageLimit
@@ -210,3 +210,72 @@ def shorten_formatted_text(
             )
 
     return output_formatted_text
+
+
+def _cut(data: bytes, start: int, end: int) -> Tuple[int, int]:
+    """
+    Picks where a chunk of UTF-16-le `data` that may run up to code unit `end` ends,
+    preferring a newline, then a space, and never inside a surrogate pair.
+    Returns the end of the chunk and where the next one starts.
+    """
+    for separator in (b"\n\x00", b" \x00"):
+        position = data.rfind(separator, 2 * start, 2 * end)
+        # Only matches at even byte offsets are whole code units
+        while position != -1 and position % 2 != 0:
+            position = data.rfind(separator, 2 * start, position + 1)
+        if position > 2 * start:
+            return position // 2, position // 2 + 1
+    if 0xD800 <= int.from_bytes(data[2 * end - 2 : 2 * end], "little") <= 0xDBFF:
+        end -= 1
+    return end, end
+
+
+def split_formatted_text(
+    formatted_text: FormattedText, length: int = MessageLimit.MAX_TEXT_LENGTH
+) -> Iterator[FormattedText]:
+    """
+    Yields chunks of at most `length` UTF-16 code units,
+    cutting entities that span a cut into one part per chunk.
+    Runs in a single pass over the text and the entities sorted by offset.
+    """
+    data = formatted_text.text.encode("UTF-16-le")
+    total = len(data) // 2
+    entities = sorted(formatted_text.entities, key=lambda entity: entity.offset)
+    next_entity = 0
+    # Entities that started in an earlier chunk and continue past it
+    open_entities: List[MessageEntity] = []
+
+    start = 0
+    while start < total:
+        if start + length >= total:
+            end, next_start = total, total
+        else:
+            end, next_start = _cut(data, start, start + length)
+
+        while next_entity < len(entities) and entities[next_entity].offset < end:
+            open_entities.append(entities[next_entity])
+            next_entity += 1
+
+        chunk = FormattedText(data[2 * start : 2 * end].decode("UTF-16-le"))
+        still_open: List[MessageEntity] = []
+        for entity in open_entities:
+            entity_start = max(entity.offset, start)
+            entity_end = min(entity.offset + entity.length, end)
+            if entity_end > entity_start:
+                chunk._entities.append(
+                    MessageEntity(
+                        type=entity.type,
+                        offset=entity_start - start,
+                        length=entity_end - entity_start,
+                        url=entity.url,
+                        user=entity.user,
+                        language=entity.language,
+                        custom_emoji_id=entity.custom_emoji_id,
+                    )
+                )
+            if entity.offset + entity.length > next_start:
+                still_open.append(entity)
+        open_entities = still_open
+
+        yield chunk
+        start = next_start
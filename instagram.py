@@ -1,150 +1,213 @@
 #!/usr/bin/env python3
+import asyncio
 import logging
+from pathlib import Path
 from types import TracebackType
-from typing import List, Optional, Set, Type, Union
-from uuid import uuid4
+from typing import Any, Dict, List, Optional, Set, Tuple, Type, Union
 
-from instagrapi import Client
+import httpx
 from telegram import (
+    Bot,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
     InlineQueryResult,
     InlineQueryResultArticle,
     InlineQueryResultPhoto,
     InlineQueryResultVideo,
-    InputMediaAudio,
-    InputMediaDocument,
     InputMediaPhoto,
     InputMediaVideo,
     InputTextMessageContent,
     Message,
     Update,
 )
-from telegram.constants import MessageLimit
-from telegram.ext import CallbackContext
-
-from captions import MediaCaptions, UserCaptions, StoryCaptions
-from formatted_text import shorten_formatted_text
-from login import login_user
+from telegram.constants import ChatAction, MediaGroupLimit, MessageLimit
+from telegram.error import BadRequest, Forbidden, TelegramError
+from telegram.ext import Application, CallbackContext
+
+import deadlines
+from cache import CacheBackend, MemoryBudget, MemoryCacheBackend, SQLiteCacheBackend
+from captions import (
+    CommentPageCaptions,
+    LikersCaptions,
+    MediaCaptions,
+    StoryCaptions,
+    UserCaptions,
+    emojis,
+)
+from cdn import expiry_ttl
+from fetcher import MAX_QUEUE_DEPTH, METADATA_TTL, InstagramFetcher
+from formatted_text import FormattedText, shorten_formatted_text, split_formatted_text
+from memory import AllocationTracker, rss_bytes
+from metrics import MetricsServer
+from phash import PerceptualIndex
+from records import MediaRecord, SentMessages
+from scheduler import Priority
+from structured_logging import log_payload
+from warming import CacheWarmer
+from watches import WATCH_PATH, AccountWatcher
 
 MAX_CAPTION_LENGTH = MessageLimit.CAPTION_LENGTH
+FILE_ID_TTL = 30 * 24 * 60 * 60
+CHAT_ACTION_INTERVAL = 4
+MEMORY_BUDGET = 64 * 2**20
+LIKERS_PAGE_SIZE = 50
+
+
+def requester_id(update: Update) -> int:
+    """Returns the ID of the Telegram user an update came from, 0 if there is none"""
+    return 0 if update.effective_user is None else update.effective_user.id
+
+
+def sent_file_id(message: Message) -> Optional[str]:
+    """Returns the Telegram file_id of the photo or video in a sent message"""
+    if message.video is not None:
+        return message.video.file_id
+    if len(message.photo) > 0:
+        return message.photo[-1].file_id
+    return None
+
+
+async def reply_in_chunks(
+    message: Message,
+    text: FormattedText,
+    reply_markup: Optional[InlineKeyboardMarkup] = None,
+) -> List[Message]:
+    """
+    Replies with a text of any length, split into as many messages as it takes,
+    the last of which carries the keyboard.
+    Each chunk is prepared while the previous one is being sent.
+    """
+    replies: List[Message] = []
+    sending: Optional["asyncio.Task[Message]"] = None
+    previous: Optional[FormattedText] = None
+    for chunk in split_formatted_text(text):
+        if previous is not None:
+            if sending is not None:
+                replies.append(await sending)
+            sending = asyncio.create_task(
+                message.reply_text(
+                    previous.text, entities=previous.entities, quote=True
+                )
+            )
+        previous = chunk
+    if sending is not None:
+        replies.append(await sending)
+    if previous is not None:
+        replies.append(
+            await message.reply_text(
+                previous.text,
+                entities=previous.entities,
+                quote=True,
+                reply_markup=reply_markup,
+            )
+        )
+    return replies
 
 
-class InstagramHandler:
-    client: Client
-    whitelist: Optional[Set[int]]
+async def keep_chat_action(bot: Bot, chat_id: Union[int, str], action: str) -> None:
+    """Shows a chat action in a chat until cancelled"""
+    while True:
+        try:
+            await bot.send_chat_action(chat_id, action)
+        except TelegramError as e:
+            logging.info("Could not send chat action: %r", e)
+        # Telegram shows an action for 5 seconds
+        await asyncio.sleep(CHAT_ACTION_INTERVAL)
+
+
+def album_groups(length: int) -> List[Tuple[int, int]]:
+    """
+    Splits an album into the fewest media groups Telegram allows, as (start, end)
+    pairs whose sizes differ by at most one, e.g. 11 items into 6 and 5
+    """
+    count = max(1, -(-length // MediaGroupLimit.MAX_MEDIA_LENGTH))
+    size, extra = divmod(length, count)
+    groups: List[Tuple[int, int]] = []
+    start = 0
+    for index in range(count):
+        end = start + size + (1 if index < extra else 0)
+        groups.append((start, end))
+        start = end
+    return groups
+
+
+def media_id(media: MediaRecord) -> str:
+    """Returns the ID the private API looks a post's comments and likers up by"""
+    return f"{media.pk}_{media.user.pk}"
+
+
+def post_keyboard(media: MediaRecord) -> Optional[InlineKeyboardMarkup]:
+    """
+    Returns the buttons that show a post's comments and likers.
+    Nothing is fetched for them until someone presses one.
+    """
+    buttons: List[InlineKeyboardButton] = []
+    if media.comment_count != 0:
+        buttons.append(
+            InlineKeyboardButton(
+                "💬 Comments", callback_data=f"comments:{media_id(media)}"
+            )
+        )
+    if media.like_count > 0:
+        buttons.append(
+            InlineKeyboardButton(
+                "❤️ Liked by", callback_data=f"likers:{media_id(media)}"
+            )
+        )
+    return InlineKeyboardMarkup([buttons]) if len(buttons) > 0 else None
 
-    def __init__(
-        self,
-        ig_user: Optional[str],
-        whitelist: Optional[Set[int]],
-        delay_range: Optional[List[int]] = None,
-    ) -> None:
-        self.whitelist = whitelist
 
-        self.client = Client()
+def page_keyboard(
+    kind: str, media_id: str, page: int, has_next: bool
+) -> Optional[InlineKeyboardMarkup]:
+    """Returns the buttons that flip through the pages of comments or likers"""
+    buttons: List[InlineKeyboardButton] = []
+    if page > 0:
+        buttons.append(
+            InlineKeyboardButton("◀️", callback_data=f"{kind}:{media_id}:{page - 1}")
+        )
+    if has_next:
+        buttons.append(
+            InlineKeyboardButton("▶️", callback_data=f"{kind}:{media_id}:{page + 1}")
+        )
+    return InlineKeyboardMarkup([buttons]) if len(buttons) > 0 else None
 
-        if ig_user is not None:
-            login_user(self.client, ig_user)
 
-        self.client.delay_range = [1, 3] if delay_range is None else delay_range
+def inline_result_id(media_pk: object, index: int, kind: str) -> str:
+    """Returns a result ID that is the same every time a media item is queried"""
+    return f"{media_pk}_{index}_{kind}"
 
-    def __enter__(self):
-        return self
 
-    def __exit__(
-        self,
-        exc_type: Optional[Type[BaseException]],
-        exc_val: Optional[BaseException],
-        exc_tb: Optional[TracebackType],
-    ) -> None:
-        """Legacy code"""
+def parse_inline_result_id(result_id: str) -> Optional[Tuple[str, int, str]]:
+    """
+    Returns the media pk, slide index and kind encoded in an inline result ID,
+    None for other results, e.g. the articles errors are reported with
+    """
+    parts = result_id.split("_")
+    if len(parts) != 3 or not parts[1].isdigit():
         return None
+    media_pk, index, kind = parts
+    return media_pk, int(index), kind
 
-    async def inlinequery(self, update: Update, context: CallbackContext) -> None:
-        """Produces results for Inline Queries"""
-        logging.info(update.inline_query)
-
-        if update.inline_query is None:
-            raise ValueError("Expected update.inline_query to not be None.")
-        # Check if there is anything typed in the inline query
-        if update.inline_query.query in ("", None):
-            return
-
-        # Check if the Telegram user is authorized to use this function
-        if (self.whitelist is not None) and (
-            update.inline_query.from_user.id not in self.whitelist
-        ):
-            await update.inline_query.answer(
-                [
-                    InlineQueryResultArticle(
-                        id=str(uuid4()),
-                        title="Unauthorized user",
-                        input_message_content=InputTextMessageContent(
-                            "Unauthorized user"
-                        ),
-                    )
-                ],
-                cache_time=300,
-                is_personal=True,
-            )
-            return
-
-        shortcode: str = update.inline_query.query
-        media = self.client.media_info(self.client.media_pk_from_code(shortcode))
-        logging.info(str(media.__dict__))
-        results: List[InlineQueryResult] = []
 
-        post_captions = MediaCaptions(media)
-        long = post_captions.long_caption()
-
-        if media.media_type == 8:  # Album
-            for counter, node in enumerate(media.resources):
-                short = post_captions.short_caption(counter)
-                if node.video_url is not None:
-                    results.append(
-                        InlineQueryResultVideo(
-                            id=str(uuid4()),
-                            video_url=node.video_url,
-                            mime_type="video/mp4",
-                            thumbnail_url=node.thumbnail_url,
-                            title="Video",
-                            caption=short.text,
-                            caption_entities=short.entities,
-                        )
-                    )
+def build_inline_results(media: MediaRecord) -> List[InlineQueryResult]:
+    """Builds the inline query results for a post"""
+    results: List[InlineQueryResult] = []
 
-                else:
-                    results.append(
-                        InlineQueryResultPhoto(
-                            id=str(uuid4()),
-                            photo_url=node.thumbnail_url,
-                            thumbnail_url=node.thumbnail_url,
-                            title="Photo",
-                            caption=short.text,
-                            caption_entities=short.entities,
-                        )
-                    )
-                results.append(
-                    InlineQueryResultArticle(
-                        id=str(uuid4()),
-                        title="URL",
-                        input_message_content=InputTextMessageContent(
-                            short.text,
-                            entities=short.entities,
-                        ),
-                        thumbnail_url=node.thumbnail_url,
-                    )
-                )
+    post_captions = MediaCaptions(media)
+    long = post_captions.long_caption()
 
-        else:
-            short = shorten_formatted_text(long)
-            if (media.media_type == 2) and (media.video_url is not None):
+    if media.media_type == 8:  # Album
+        for counter, node in enumerate(media.resources):
+            short = post_captions.short_caption(counter)
+            if node.video_url is not None:
                 results.append(
                     InlineQueryResultVideo(
-                        id=str(uuid4()),
-                        title="Video",
-                        video_url=media.video_url,
-                        thumbnail_url=media.thumbnail_url,
+                        id=inline_result_id(media.pk, counter, "video"),
+                        video_url=node.video_url,
                         mime_type="video/mp4",
+                        thumbnail_url=node.thumbnail_url,
+                        title="Video",
                         caption=short.text,
                         caption_entities=short.entities,
                     )
@@ -153,118 +216,402 @@ class InstagramHandler:
             else:
                 results.append(
                     InlineQueryResultPhoto(
-                        id=str(uuid4()),
+                        id=inline_result_id(media.pk, counter, "photo"),
+                        photo_url=node.thumbnail_url,
+                        thumbnail_url=node.thumbnail_url,
                         title="Photo",
-                        photo_url=media.thumbnail_url,
-                        thumbnail_url=media.thumbnail_url,
                         caption=short.text,
                         caption_entities=short.entities,
                     )
                 )
             results.append(
                 InlineQueryResultArticle(
-                    id=str(uuid4()),
+                    id=inline_result_id(media.pk, counter, "url"),
                     title="URL",
                     input_message_content=InputTextMessageContent(
                         short.text,
                         entities=short.entities,
                     ),
+                    thumbnail_url=node.thumbnail_url,
+                )
+            )
+
+    else:
+        short = shorten_formatted_text(long)
+        if (media.media_type == 2) and (media.video_url is not None):
+            results.append(
+                InlineQueryResultVideo(
+                    id=inline_result_id(media.pk, 0, "video"),
+                    title="Video",
+                    video_url=media.video_url,
                     thumbnail_url=media.thumbnail_url,
+                    mime_type="video/mp4",
+                    caption=short.text,
+                    caption_entities=short.entities,
                 )
             )
-        await update.inline_query.answer(results, cache_time=21600, is_personal=False)
 
-    async def posts(self, update: Update, context: CallbackContext) -> None:
-        """Returns posts"""
-        logging.info(str(update.message))
+        else:
+            results.append(
+                InlineQueryResultPhoto(
+                    id=inline_result_id(media.pk, 0, "photo"),
+                    title="Photo",
+                    photo_url=media.thumbnail_url,
+                    thumbnail_url=media.thumbnail_url,
+                    caption=short.text,
+                    caption_entities=short.entities,
+                )
+            )
+        results.append(
+            InlineQueryResultArticle(
+                id=inline_result_id(media.pk, 0, "url"),
+                title="URL",
+                input_message_content=InputTextMessageContent(
+                    short.text,
+                    entities=short.entities,
+                ),
+                thumbnail_url=media.thumbnail_url,
+            )
+        )
+    return results
 
-        if update.message is None:
-            raise ValueError("Expected update.message to not be None.")
 
-        if (self.whitelist is not None) and (
-            (update.message.from_user is not None)
-            and (update.message.from_user.id not in self.whitelist)
-        ):
-            await update.message.reply_text("Unauthorized user", quote=True)
-            return
+class InstagramHandler:
+    fetcher: InstagramFetcher
+    cache: CacheBackend
+    budget: MemoryBudget
+    allocations: AllocationTracker
+    admins: Set[int]
+    watcher: AccountWatcher
+    images: PerceptualIndex
+    metrics: Optional[MetricsServer]
+    warmer: Optional[CacheWarmer]
 
-        if (context.args is None) or (len(context.args) < 1):
-            await update.message.reply_text(
-                "Please run the command with a shortcode.", quote=True
+    def __init__(
+        self,
+        ig_user: Optional[str],
+        delay_range: Optional[List[int]] = None,
+        user_rate: Optional[float] = None,
+        user_burst: float = 5,
+        session_path: Optional[Path] = None,
+        cache_path: Optional[Path] = None,
+        concurrency: int = 1,
+        watch_path: Path = WATCH_PATH,
+        admins: Optional[Set[int]] = None,
+        memory_budget: int = MEMORY_BUDGET,
+        record_path: Optional[Path] = None,
+        replay_path: Optional[Path] = None,
+        max_queue_depth: Optional[int] = MAX_QUEUE_DEPTH,
+        metrics_port: Optional[int] = None,
+        warm_path: Optional[Path] = None,
+        warm_shard: Optional[Tuple[int, int]] = None,
+    ) -> None:
+        self.admins = set() if admins is None else admins
+        self.budget = MemoryBudget(memory_budget)
+        self.allocations = AllocationTracker()
+        self.cache = (
+            MemoryCacheBackend(budget=self.budget)
+            if cache_path is None
+            else SQLiteCacheBackend(cache_path)
+        )
+        self.fetcher = InstagramFetcher(
+            ig_user,
+            delay_range,
+            concurrency=concurrency,
+            user_rate=user_rate,
+            user_burst=user_burst,
+            session_path=session_path,
+            cache=self.cache,
+            budget=self.budget,
+            record_path=record_path,
+            replay_path=replay_path,
+            max_queue_depth=max_queue_depth,
+        )
+        self.watcher = AccountWatcher(self, watch_path)
+        self.images = PerceptualIndex(self.cache, FILE_ID_TTL)
+        self.metrics = (
+            None
+            if metrics_port is None
+            else MetricsServer(metrics_port, self.collect_metrics)
+        )
+        self.warmer = (
+            None
+            if warm_path is None
+            else CacheWarmer(self, warm_path, shard=warm_shard)
+        )
+
+    async def start(self, application: Application) -> None:
+        await self.fetcher.start(application)
+        self.watcher.start(application)
+        if self.metrics is not None:
+            await self.metrics.start()
+        if self.warmer is not None:
+            self.warmer.start(application)
+
+    async def stop(self, application: Application) -> None:
+        if self.metrics is not None:
+            await self.metrics.stop()
+        await self.fetcher.stop()
+        self.images.close()
+
+    def collect_metrics(self) -> Dict[str, float]:
+        """Returns the load of the Instagram fetch layer, e.g. for autoscaling"""
+        scheduler = self.fetcher.scheduler
+        metrics: Dict[str, float] = {
+            "igtgbot_queue_depth": len(scheduler),
+            "igtgbot_running_lookups": scheduler.running,
+            "igtgbot_shed_lookups_total": scheduler.shed,
+        }
+        if scheduler.max_depth is not None:
+            metrics["igtgbot_queue_max_depth"] = scheduler.max_depth
+        for priority, depth in scheduler.depths().items():
+            metrics[f'igtgbot_queue_depth{{priority="{priority.name.lower()}"}}'] = (
+                depth
             )
+        for operation, count in self.fetcher.timeouts.items():
+            metrics[f'igtgbot_timeouts_total{{operation="{operation}"}}'] = count
+        return metrics
+
+    def __enter__(self):
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_val: Optional[BaseException],
+        exc_tb: Optional[TracebackType],
+    ) -> None:
+        self.cache.close()
+        return None
+
+    def _media_source(self, pk: object, url: Any) -> Any:
+        """Returns the file_id of an earlier upload of a media item, else its URL"""
+        file_id = self.cache.get(f"file_id:{pk}")
+        return url if file_id is None else file_id
+
+    async def _photo_source(
+        self, url: str, pk: Optional[object] = None
+    ) -> Tuple[Any, Optional[int]]:
+        """
+        Returns the file_id of an earlier upload of a photo, else its URL,
+        along with its perceptual hash.
+        Photos are matched by their pk first, then by what they look like.
+        The photo is only downloaded to be hashed, Telegram fetches the URL itself.
+        """
+        if pk is not None:
+            file_id = self.cache.get(f"file_id:{pk}")
+            if file_id is not None:
+                return file_id, None
+        try:
+            data = await self.fetcher.transport.download(url)
+        except httpx.HTTPError as e:
+            logging.info("Could not download %s: %r", url, e)
+            return url, None
+        image_hash = await self.images.hash(data)
+        if image_hash is None:
+            return url, None
+        file_id = self.images.find(image_hash)
+        return (url if file_id is None else file_id), image_hash
+
+    def _remember_file_id(
+        self,
+        pk: Optional[object],
+        message: Message,
+        image_hash: Optional[int] = None,
+    ) -> None:
+        file_id = sent_file_id(message)
+        if file_id is None:
             return
+        if pk is not None:
+            self.cache.set(f"file_id:{pk}", file_id, FILE_ID_TTL)
+        if image_hash is not None:
+            self.images.add(image_hash, file_id)
+
+    async def _album_group(
+        self, media: MediaRecord, post_captions: MediaCaptions, start: int, end: int
+    ) -> Tuple[List[Union[InputMediaPhoto, InputMediaVideo]], List[Optional[int]]]:
+        """
+        Prepares the items of an album from `start` to `end` as one media group.
+        Also returns the perceptual hashes of its photos.
+        """
+        media_group: List[Union[InputMediaPhoto, InputMediaVideo]] = []
+        image_hashes: List[Optional[int]] = []
+        for counter in range(start, end):
+            node = media.resources[counter]
+            short = post_captions.short_caption(counter)
+            if node.video_url is not None:
+                media_group.append(
+                    InputMediaVideo(
+                        media=self._media_source(node.pk, node.video_url),
+                        caption=short.text,
+                        caption_entities=short.entities,
+                    )
+                )
+                image_hashes.append(None)
+            else:
+                photo, image_hash = await self._photo_source(
+                    node.thumbnail_url, node.pk
+                )
+                media_group.append(
+                    InputMediaPhoto(
+                        media=photo,
+                        caption=short.text,
+                        caption_entities=short.entities,
+                    )
+                )
+                image_hashes.append(image_hash)
+        for input_medium in media_group:
+            log_payload("input_medium", input_medium, logging.DEBUG)
+        return media_group, image_hashes
 
-        shortcode: str = context.args[0]
-        is_ig_post: bool = True
+    async def _send_album(
+        self,
+        bot: Bot,
+        chat_id: Union[int, str],
+        reply_to: Optional[int],
+        media: MediaRecord,
+        post_captions: MediaCaptions,
+    ) -> List[Message]:
+        """
+        Sends an album in as few media groups as Telegram allows,
+        preparing each group while the previous one is being sent.
+        Their sizes are balanced, as each needs at least two items.
+        """
+        replies: List[Message] = []
+        image_hashes: List[Optional[int]] = []
+        action = asyncio.create_task(
+            keep_chat_action(bot, chat_id, ChatAction.UPLOAD_PHOTO)
+        )
+        try:
+            sending: Optional["asyncio.Task[Tuple[Message, ...]]"] = None
+            for start, end in album_groups(len(media.resources)):
+                media_group, group_hashes = await self._album_group(
+                    media, post_captions, start, end
+                )
+                image_hashes.extend(group_hashes)
+                if sending is not None:
+                    replies.extend(await sending)
+                sending = asyncio.create_task(
+                    bot.send_media_group(
+                        chat_id, media=media_group, reply_to_message_id=reply_to
+                    )
+                )
+            if sending is not None:
+                replies.extend(await sending)
+        finally:
+            action.cancel()
+        for node, sent_message, image_hash in zip(
+            media.resources, replies, image_hashes
+        ):
+            self._remember_file_id(node.pk, sent_message, image_hash)
+        return replies
+
+    def _remember_sent(self, key: str, messages: List[Message]) -> None:
+        """Records the messages a post was sent in"""
+        self.cache.set(
+            f"sent:{key}",
+            SentMessages(
+                messages[0].chat_id,
+                tuple(message.message_id for message in messages),
+                messages[0].media_group_id,
+            ),
+            METADATA_TTL,
+        )
 
-        if not is_ig_post:
-            await update.message.reply_text("Not an Instagram post", quote=True)
+    async def _send_again(
+        self, key: str, bot: Bot, chat_id: Union[int, str], reply_to: Optional[int]
+    ) -> bool:
+        """
+        Answers a repeat request for a post without uploading it again:
+        in the chat it was sent to, by replying to the earlier messages,
+        elsewhere by copying them. Returns False if there is nothing to reuse.
+        """
+        sent: Optional[SentMessages] = self.cache.get(f"sent:{key}")
+        if sent is None:
+            return False
+        try:
+            if sent.chat_id == chat_id:
+                await bot.send_message(
+                    chat_id,
+                    "Sent here before ⬆️",
+                    reply_to_message_id=sent.message_ids[0],
+                    allow_sending_without_reply=False,
+                )
+            elif len(sent.message_ids) == 1:
+                await bot.copy_message(
+                    chat_id,
+                    sent.chat_id,
+                    sent.message_ids[0],
+                    reply_to_message_id=reply_to,
+                )
+            else:
+                # Copies of an album's items are sent as an album again
+                await bot.copy_messages(chat_id, sent.chat_id, sent.message_ids)
+        except (BadRequest, Forbidden) as e:
+            # The earlier messages were deleted or the bot left their chat
+            logging.info("Could not reuse messages of %s: %r", key, e)
+            self.cache.delete(f"sent:{key}")
+            return False
+        return True
+
+    async def send_post(
+        self,
+        bot: Bot,
+        chat_id: Union[int, str],
+        media: MediaRecord,
+        reply_to: Optional[int] = None,
+    ) -> None:
+        """Sends a post with its captions to a chat, or reuses an earlier copy"""
+        key = f"media:{media.code}"
+        if await self._send_again(key, bot, chat_id, reply_to):
             return
-        media = self.client.media_info(self.client.media_pk_from_code(shortcode))
-        logging.info(str(media.__dict__))
 
         post_captions = MediaCaptions(media)
         long = post_captions.long_caption()
+        keyboard = post_keyboard(media)
 
         if media.media_type == 8:  # Album
-            media_group: List[
-                Union[
-                    InputMediaAudio,
-                    InputMediaDocument,
-                    InputMediaPhoto,
-                    InputMediaVideo,
-                ]
-            ] = []
-            for counter, node in enumerate(media.resources):
-                short = post_captions.short_caption(counter)
-                if node.video_url is not None:
-                    media_group.append(
-                        InputMediaVideo(
-                            media=node.video_url,
-                            caption=short.text,
-                            caption_entities=short.entities,
-                        )
-                    )
-                else:
-                    media_group.append(
-                        InputMediaPhoto(
-                            media=node.thumbnail_url,
-                            caption=short.text,
-                            caption_entities=short.entities,
-                        )
-                    )
-            for input_medium in media_group:
-                logging.info(input_medium)
-            media_reply: Optional[Message] = (
-                await update.message.reply_media_group(
-                    media=media_group,
-                    quote=True,
-                )
-            )[-1]
+            sent_messages = await self._send_album(
+                bot, chat_id, reply_to, media, post_captions
+            )
+            media_reply: Optional[Message] = sent_messages[-1]
 
         else:
             short = shorten_formatted_text(long)
+            # When the full caption follows, the buttons go below it instead
+            media_keyboard = None if len(long) > MAX_CAPTION_LENGTH else keyboard
+            image_hash: Optional[int] = None
             if (media.media_type == 2) and (media.video_url is not None):
-                media_reply = await update.message.reply_video(
-                    video=media.video_url,
-                    quote=True,
+                media_reply = await bot.send_video(
+                    chat_id,
+                    video=self._media_source(media.pk, media.video_url),
+                    reply_to_message_id=reply_to,
                     caption=short.text,
                     caption_entities=short.entities,
+                    reply_markup=media_keyboard,
                 )
 
             else:
                 if media.media_type != 1:
                     logging.info("Post type irregular: %s", media.media_type)
-                    await update.message.reply_text(
+                    await bot.send_message(
+                        chat_id,
                         f"Invalid type: {media.media_type}, will try to send as image.",
-                        quote=True,
+                        reply_to_message_id=reply_to,
                     )
-                media_reply = await update.message.reply_photo(
-                    photo=media.thumbnail_url,
-                    quote=True,
+                photo, image_hash = await self._photo_source(
+                    media.thumbnail_url, media.pk
+                )
+                media_reply = await bot.send_photo(
+                    chat_id,
+                    photo=photo,
+                    reply_to_message_id=reply_to,
                     caption=short.text,
                     caption_entities=short.entities,
+                    reply_markup=media_keyboard,
                 )
+            self._remember_file_id(media.pk, media_reply, image_hash)
+            sent_messages = [media_reply]
 
         if (media_reply is not None) and (
             (len(long) > MAX_CAPTION_LENGTH)
@@ -273,22 +620,152 @@ class InstagramHandler:
                 and (len(post_captions.long_caption(0)) > MAX_CAPTION_LENGTH)
             )
         ):
-            await media_reply.reply_text(long.text, entities=long.entities, quote=True)
+            # The full caption follows the post, so the buttons go below it
+            sent_messages.extend(await reply_in_chunks(media_reply, long, keyboard))
+        elif (media.media_type == 8) and (keyboard is not None):
+            # Media groups can't carry buttons
+            sent_messages.append(
+                await bot.send_message(
+                    chat_id,
+                    f"{emojis['heart']}{media.like_count}"
+                    f" {emojis['comments']}{media.comment_count}",
+                    reply_to_message_id=sent_messages[0].message_id,
+                    reply_markup=keyboard,
+                )
+            )
+        self._remember_sent(key, sent_messages)
+
+    def cache_inline_results(self, media: MediaRecord) -> List[InlineQueryResult]:
+        """Builds the inline query results for a post and caches them"""
+        results = build_inline_results(media)
+        self.cache.set(f"inline:{media.code}", results, expiry_ttl(media, METADATA_TTL))
+        return results
+
+    async def interactions(self, update: Update, context: CallbackContext) -> None:
+        """
+        Shows a page of a post's comments or likers when a button is pressed.
+        The buttons under a post reply with the first page,
+        the buttons under a page turn it in place.
+        """
+        query = update.callback_query
+        if query is None or query.data is None:
+            raise ValueError("Expected update.callback_query to have data.")
+        if not isinstance(query.message, Message):
+            # The message was deleted or is otherwise unavailable to the bot
+            raise ValueError("Expected update.callback_query.message to be accessible.")
+        kind, post_id, *rest = query.data.split(":")
+        page = int(rest[0]) if len(rest) > 0 else 0
+
+        if kind == "comments":
+            comment_page = await self.fetcher.media_comments(
+                query.from_user.id, post_id, page
+            )
+            text = CommentPageCaptions(comment_page, page).short_caption()
+            has_next = comment_page.cursor is not None
+        else:
+            likers = await self.fetcher.media_likers(query.from_user.id, post_id)
+            start = page * LIKERS_PAGE_SIZE
+            text = LikersCaptions(
+                likers[start : start + LIKERS_PAGE_SIZE], start, len(likers)
+            ).short_caption()
+            has_next = start + LIKERS_PAGE_SIZE < len(likers)
+        keyboard = page_keyboard(kind, post_id, page, has_next)
+
+        if len(rest) == 0:
+            await query.message.reply_text(
+                text.text, entities=text.entities, quote=True, reply_markup=keyboard
+            )
+        else:
+            await query.edit_message_text(
+                text.text, entities=text.entities, reply_markup=keyboard
+            )
+        if deadlines.remaining() != 0:
+            await query.answer()
 
-    async def story_item(self, update: Update, context: CallbackContext) -> None:
-        """Returns story items"""
-        logging.info(str(update.message))
+    async def inlinequery(self, update: Update, context: CallbackContext) -> None:
+        """Produces results for Inline Queries"""
+        log_payload("inline_query", update.inline_query)
+
+        if update.inline_query is None:
+            raise ValueError("Expected update.inline_query to not be None.")
+        # Check if there is anything typed in the inline query
+        if update.inline_query.query in ("", None):
+            return
+
+        shortcode: str = update.inline_query.query
+        cached_results: Optional[List[InlineQueryResult]] = self.cache.get(
+            f"inline:{shortcode}"
+        )
+        if cached_results is not None:
+            await update.inline_query.answer(
+                cached_results, cache_time=21600, is_personal=False
+            )
+            return
+
+        media = await self.fetcher.media_info(
+            update.inline_query.from_user.id, shortcode, Priority.INLINE
+        )
+        log_payload("media", media)
+        results = self.cache_inline_results(media)
+
+        if deadlines.remaining() == 0:
+            # Telegram dropped the query, the results are cached for its retry
+            logging.info("Inline query for %s answered too late", shortcode)
+            return
+        await update.inline_query.answer(results, cache_time=21600, is_personal=False)
+
+    async def chosen_inline_result(
+        self, update: Update, context: CallbackContext
+    ) -> None:
+        """Records which inline result was sent"""
+        if update.chosen_inline_result is None:
+            raise ValueError("Expected update.chosen_inline_result to not be None.")
+        parsed = parse_inline_result_id(update.chosen_inline_result.result_id)
+        if parsed is None:
+            return
+        media_pk, index, kind = parsed
+        logging.info(
+            "Inline result chosen: media %s, item %s, %s", media_pk, index, kind
+        )
+
+    async def posts(self, update: Update, context: CallbackContext) -> None:
+        """Returns posts"""
+        log_payload("message", update.message)
 
         if update.message is None:
             raise ValueError("Expected update.message to not be None.")
 
-        if (
-            (self.whitelist is not None)
-            and (update.message.from_user is not None)
-            and (update.message.from_user.id not in self.whitelist)
+        if (context.args is None) or (len(context.args) < 1):
+            await update.message.reply_text(
+                "Please run the command with a shortcode.", quote=True
+            )
+            return
+
+        shortcode: str = context.args[0]
+        is_ig_post: bool = True
+
+        if not is_ig_post:
+            await update.message.reply_text("Not an Instagram post", quote=True)
+            return
+        if await self._send_again(
+            f"media:{shortcode}",
+            context.bot,
+            update.message.chat_id,
+            update.message.message_id,
         ):
-            await update.message.reply_text("Unauthorized user", quote=True)
             return
+        media = await self.fetcher.media_info(requester_id(update), shortcode)
+        log_payload("media", media)
+        await self.send_post(
+            context.bot, update.message.chat_id, media, update.message.message_id
+        )
+
+    async def story_item(self, update: Update, context: CallbackContext) -> None:
+        """Returns story items"""
+        log_payload("message", update.message)
+
+        if update.message is None:
+            raise ValueError("Expected update.message to not be None.")
 
         if (context.args is None) or (len(context.args) < 1):
             await update.message.reply_text(
@@ -306,46 +783,44 @@ class InstagramHandler:
         if not is_ig_story_item:
             await update.message.reply_text("Not an Instagram story item", quote=True)
             return
-        story_item = self.client.story_info(str(media_id))
-        logging.info(str(story_item.__dict__))
+        story_item = await self.fetcher.story_info(requester_id(update), media_id)
+        log_payload("story_item", story_item)
 
         story_item_captions = StoryCaptions(story_item)
         short = story_item_captions.short_caption()
+        image_hash: Optional[int] = None
         if (story_item.media_type == 2) and (story_item.video_url is not None):
             first_reply = await update.message.reply_video(
-                video=story_item.video_url,
+                video=self._media_source(story_item.pk, story_item.video_url),
                 quote=True,
                 caption=short.text,
                 caption_entities=short.entities,
             )
 
         else:
+            photo, image_hash = await self._photo_source(
+                story_item.thumbnail_url, story_item.pk
+            )
             first_reply = await update.message.reply_photo(
-                photo=story_item.thumbnail_url,
+                photo=photo,
                 quote=True,
                 caption=short.text,
                 caption_entities=short.entities,
             )
+        self._remember_file_id(story_item.pk, first_reply, image_hash)
         long = story_item_captions.long_caption()
         if len(long.text) > MAX_CAPTION_LENGTH:
-            await first_reply.reply_text(long.text, entities=long.entities, quote=True)
+            await reply_in_chunks(first_reply, long)
 
     async def _profile(
         self, update: Update, context: CallbackContext, is_id: bool
     ) -> None:
         """Returns Instagram profiles"""
-        logging.info(str(update.message))
+        log_payload("message", update.message)
 
         if update.message is None:
             raise ValueError("Expected update.message to not be None.")
 
-        if (
-            (self.whitelist is not None)
-            and (update.message.from_user is not None)
-            and (update.message.from_user.id not in self.whitelist)
-        ):
-            await update.message.reply_text("Unauthorized user", quote=True)
-            return
         if (context.args is None) or (len(context.args) < 1):
             await update.message.reply_text(
                 "Please run the command with a profile username.", quote=True
@@ -357,23 +832,75 @@ class InstagramHandler:
             await update.message.reply_text("Not an Instagram profile", quote=True)
             return
         user = (
-            self.client.user_info(id_or_username)
+            await self.fetcher.user_info(requester_id(update), id_or_username)
             if is_id
-            else self.client.user_info_by_username(id_or_username)
+            else await self.fetcher.user_info_by_username(
+                requester_id(update), id_or_username
+            )
         )
-        logging.info(str(user.__dict__))
+        log_payload("user", user)
 
         profile_captions = UserCaptions(user)
         short = profile_captions.short_caption()
+        # Profile pictures change under the same URL pattern, so only their hash is kept
+        photo, image_hash = await self._photo_source(user.profile_pic_url)
         first_reply = await update.message.reply_photo(
-            photo=user.profile_pic_url,
+            photo=photo,
             quote=True,
             caption=short.text,
             caption_entities=short.entities,
         )
+        self._remember_file_id(None, first_reply, image_hash)
         long = profile_captions.long_caption()
         if len(long.text) > MAX_CAPTION_LENGTH:
-            await first_reply.reply_text(long.text, entities=long.entities, quote=True)
+            await reply_in_chunks(first_reply, long)
+
+    async def status(self, update: Update, context: CallbackContext) -> None:
+        """Returns the state of the Instagram fetch layer"""
+        if update.message is None:
+            raise ValueError("Expected update.message to not be None.")
+        await update.message.reply_text(
+            "\n".join(
+                [
+                    f"Instagram: {self.fetcher.breaker.status()}",
+                    f"Queued lookups: {len(self.fetcher.scheduler)}"
+                    + (
+                        ""
+                        if self.fetcher.scheduler.max_depth is None
+                        else f" of at most {self.fetcher.scheduler.max_depth}"
+                    )
+                    + f", {self.fetcher.scheduler.shed} shed",
+                    "Timeouts: "
+                    + (
+                        ", ".join(
+                            f"{operation} {count}"
+                            for operation, count in sorted(
+                                self.fetcher.timeouts.items()
+                            )
+                        )
+                        or "none"
+                    ),
+                    *self.fetcher.endpoints.status(),
+                ]
+            ),
+            quote=True,
+        )
+
+    async def memory(self, update: Update, context: CallbackContext) -> None:
+        """Shows memory use and, to admins, where allocations grew"""
+        if update.message is None:
+            raise ValueError("Expected update.message to not be None.")
+        if (update.effective_user is None) or (
+            update.effective_user.id not in self.admins
+        ):
+            await update.message.reply_text("Only admins can do this", quote=True)
+            return
+        lines = [
+            f"RSS: {rss_bytes() / 2**20:.1f} MiB",
+            f"Cache: {self.budget.status()}",
+            *await asyncio.to_thread(self.allocations.report),
+        ]
+        await reply_in_chunks(update.message, FormattedText("\n".join(lines)))
 
     async def profile(self, update: Update, context: CallbackContext) -> None:
         """Returns Instagram profiles"""
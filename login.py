@@ -4,23 +4,53 @@ https://github.com/adw0rd/instagrapi/blob/abea0b7cf584f08852a1d3b23c97555c9731a4
 """
 
 import logging
+import os
 from pathlib import Path
+from typing import Optional, Tuple
 
 from instagrapi import Client
 from instagrapi.exceptions import LoginRequired
 
 logger = logging.getLogger()
 
+SESSION_PATH = Path("session.json")
 
-def login_user(cl: Client, username: str) -> None:
+
+def env_credentials() -> Tuple[Optional[str], Optional[str]]:
+    """Returns the password and TOTP seed provided through the environment, if any."""
+    return os.environ.get("IG_PASSWORD"), os.environ.get("IG_TOTP_SEED")
+
+
+def login_with_credentials(
+    cl: Client, username: str, password: str, totp_seed: Optional[str]
+) -> bool:
+    """Logs in without prompting, generating a 2FA code from the TOTP seed if given."""
+    totp = cl.totp_generate_code(totp_seed) if totp_seed else ""
+    logger.info("Attempting to login via username and password. username: %s", username)
+    return cl.login(username, password, verification_code=totp)
+
+
+def validate_session(cl: Client) -> bool:
+    """Checks whether Instagram still accepts the client's session."""
+    try:
+        cl.get_timeline_feed()
+    except LoginRequired:
+        return False
+    return True
+
+
+def login_user(cl: Client, username: str, settings_path: Path = SESSION_PATH) -> None:
     """
     Attempts to login to Instagram using either the provided session information
     or the provided username and password.
+    The password and TOTP seed are taken from IG_PASSWORD and IG_TOTP_SEED,
+    and are only prompted for when those are not set.
     """
-    password = ""
+    env_password, totp_seed = env_credentials()
+    password = "" if env_password is None else env_password
     totp = ""
 
-    SETTINGS = Path("session.json")
+    SETTINGS = settings_path
 
     try:
         session = cl.load_settings(SETTINGS)
@@ -36,9 +66,7 @@ def login_user(cl: Client, username: str) -> None:
             cl.login(username, password)
 
             # check if session is valid
-            try:
-                cl.get_timeline_feed()
-            except LoginRequired:
+            if not validate_session(cl):
                 logger.info(
                     "Session is invalid, need to login via username and password"
                 )
@@ -55,14 +83,20 @@ def login_user(cl: Client, username: str) -> None:
             logger.info("Couldn't login user using session information: %s", e)
 
     if not login_via_session:
-        password = input(f"Enter a password for instagram account {username}: ")
-        totp = input(f"Auth code, if applicable: ")
         try:
-            logger.info(
-                "Attempting to login via username and password. username: %s", username
-            )
-            if cl.login(username, password, verification_code=totp):
-                login_via_pw = True
+            if env_password is not None:
+                login_via_pw = login_with_credentials(
+                    cl, username, env_password, totp_seed
+                )
+            else:
+                password = input(f"Enter a password for instagram account {username}: ")
+                totp = input(f"Auth code, if applicable: ")
+                logger.info(
+                    "Attempting to login via username and password. username: %s",
+                    username,
+                )
+                if cl.login(username, password, verification_code=totp):
+                    login_via_pw = True
         except Exception as e:
             logger.info("Couldn't login user using username and password: %s", e)
 
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+import resource
+import tracemalloc
+from pathlib import Path
+from typing import List, Optional
+
+TRACE_FRAMES = 10
+TOP_STATISTICS = 10
+
+
+def rss_bytes() -> int:
+    """Returns the resident set size of this process, or its peak where unavailable"""
+    statm = Path("/proc/self/statm")
+    if statm.exists():
+        return int(statm.read_text().split()[1]) * resource.getpagesize()
+    # Kilobytes on Linux, but only the peak
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class AllocationTracker:
+    """
+    Compares tracemalloc snapshots to show where memory grew since the last look.
+    Tracing slows allocations down, so it only starts when first asked for.
+    """
+
+    _snapshot: Optional[tracemalloc.Snapshot]
+
+    def __init__(self) -> None:
+        self._snapshot = None
+
+    def report(self) -> List[str]:
+        """Returns the allocation sites that grew most since the previous report"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACE_FRAMES)
+            self._snapshot = tracemalloc.take_snapshot()
+            return ["Started tracing allocations, ask again later for a comparison"]
+
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            )
+        )
+        lines: List[str] = []
+        if self._snapshot is not None:
+            for statistic in snapshot.compare_to(self._snapshot, "lineno")[
+                :TOP_STATISTICS
+            ]:
+                frame = statistic.traceback[0]
+                lines.append(
+                    f"{Path(frame.filename).name}:{frame.lineno}"
+                    f" {statistic.size_diff / 1024:+.1f} KiB"
+                    f" ({statistic.count_diff:+d} blocks),"
+                    f" {statistic.size / 1024:.1f} KiB total"
+                )
+        self._snapshot = snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        lines.append(f"Traced: {current / 2**20:.1f} MiB, peak {peak / 2**20:.1f} MiB")
+        return lines
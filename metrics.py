@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+import asyncio
+import logging
+from typing import Callable, Dict, Optional
+
+METRICS_HOST = "0.0.0.0"
+# Requests are only ever "GET /metrics", anything longer is not a scraper
+MAX_REQUEST_SIZE = 8 * 1024
+
+
+def render(metrics: Dict[str, float]) -> str:
+    """Formats gauges in the Prometheus text format"""
+    return "".join(f"{name} {value}\n" for name, value in sorted(metrics.items()))
+
+
+class MetricsServer:
+    """
+    Serves the current value of some gauges over plain HTTP,
+    e.g. the depth of the lookup queue for an autoscaler to scrape.
+    Every path answers with all metrics.
+    """
+
+    port: int
+    collect: Callable[[], Dict[str, float]]
+    _server: Optional[asyncio.AbstractServer]
+
+    def __init__(self, port: int, collect: Callable[[], Dict[str, float]]) -> None:
+        self.port = port
+        self.collect = collect
+        self._server = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(
+            self._handle, METRICS_HOST, self.port, limit=MAX_REQUEST_SIZE
+        )
+        logging.info("Serving metrics on port %s", self.port)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            # Headers are read and ignored
+            await reader.readuntil(b"\r\n\r\n")
+            body = render(self.collect()).encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                + f"Content-Length: {len(body)}\r\n".encode()
+                + b"Connection: close\r\n\r\n"
+                + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, OSError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from typing import List, Optional, Tuple
+
+from cache import CacheBackend
+
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+# Images whose hashes differ in at most this many bits are taken to be the same
+MAX_DISTANCE = 4
+# Split hashes into one more band than MAX_DISTANCE: two hashes within
+# MAX_DISTANCE bits of each other then agree on at least one whole band
+BANDS = MAX_DISTANCE + 1
+HASH_WORKERS = 2
+
+
+def dhash(data: bytes) -> Optional[int]:
+    """
+    Returns the 64 bit difference hash of an image: whether each pixel of a
+    9x8 grayscale thumbnail is brighter than its right neighbour.
+    Runs in a worker process, returns None for data Pillow can't decode.
+    """
+    from PIL import Image, UnidentifiedImageError
+
+    try:
+        with Image.open(BytesIO(data)) as image:
+            # Lets JPEGs decode at a fraction of their size
+            image.draft("L", (HASH_SIZE * 8, HASH_SIZE * 8))
+            pixels = list(
+                image.convert("L")
+                .resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.LANCZOS)
+                .getdata()
+            )
+    except (UnidentifiedImageError, OSError):
+        return None
+    value = 0
+    for row in range(HASH_SIZE):
+        for column in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + column]
+            right = pixels[row * (HASH_SIZE + 1) + column + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def bands(image_hash: int) -> List[Tuple[int, int]]:
+    """Returns the index and value of each band of a hash"""
+    result: List[Tuple[int, int]] = []
+    start = 0
+    for band in range(BANDS):
+        width = (HASH_BITS - start) // (BANDS - band)
+        result.append((band, (image_hash >> start) & ((1 << width) - 1)))
+        start += width
+    return result
+
+
+class PerceptualIndex:
+    """
+    Maps perceptual hashes of sent images to their Telegram file_ids,
+    so an image that was already uploaded, even from another URL or
+    re-encoded by a reposting account, is sent by reference.
+    Buckets live in the cache backend, shared with other bot instances.
+    """
+
+    cache: CacheBackend
+    ttl: float
+    _pool: Optional[ProcessPoolExecutor]
+
+    def __init__(self, cache: CacheBackend, ttl: float) -> None:
+        self.cache = cache
+        self.ttl = ttl
+        self._pool = None
+
+    async def hash(self, data: bytes) -> Optional[int]:
+        """Hashes an image in the worker pool"""
+        if self._pool is None:
+            # Forking a process that runs an event loop and threads is unsafe
+            self._pool = ProcessPoolExecutor(
+                HASH_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+        return await asyncio.get_running_loop().run_in_executor(self._pool, dhash, data)
+
+    def find(self, image_hash: int) -> Optional[str]:
+        """Returns the file_id of the closest indexed image, if it is close enough"""
+        best: Optional[Tuple[int, str]] = None
+        for band, value in bands(image_hash):
+            for other_hash, file_id in self.cache.get(f"phash:{band}:{value}") or ():
+                distance = hamming(image_hash, other_hash)
+                if distance <= MAX_DISTANCE and (best is None or distance < best[0]):
+                    best = (distance, file_id)
+        if best is not None:
+            logging.debug("Image %016x matched at distance %s", image_hash, best[0])
+        return None if best is None else best[1]
+
+    def add(self, image_hash: int, file_id: str) -> None:
+        for band, value in bands(image_hash):
+            key = f"phash:{band}:{value}"
+            bucket: Tuple[Tuple[int, str], ...] = self.cache.get(key) or ()
+            bucket = tuple(entry for entry in bucket if entry[0] != image_hash)
+            self.cache.set(key, bucket + ((image_hash, file_id),), self.ttl)
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import logging
+from datetime import datetime
+from typing import TYPE_CHECKING, Any, Callable, Iterator, Optional, Tuple, TypeVar
+
+from structures import deep_sizeof
+
+if TYPE_CHECKING:
+    from instagrapi.types import (
+        Comment,
+        Location,
+        Media,
+        Resource,
+        Story,
+        User,
+        UserShort,
+    )
+
+
+R = TypeVar("R", bound="Record")
+M = TypeVar("M")
+
+
+def _optional_str(value: Any) -> Optional[str]:
+    return None if value is None else str(value)
+
+
+class Record:
+    """
+    Compact copy of the few fields of an instagrapi model the bot uses.
+    Records are what the caches hold, instead of whole pydantic models.
+    """
+
+    __slots__: Tuple[str, ...] = ()
+
+    def _fields(self) -> Iterator[Tuple[str, Any]]:
+        for field in self.__slots__:
+            yield field, getattr(self, field)
+
+    def __eq__(self, other: object) -> bool:
+        if type(self) is not type(other):
+            return NotImplemented
+        return tuple(self._fields()) == tuple(other._fields())  # type: ignore
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{field}={value!r}" for field, value in self._fields())
+        return f"{self.__class__.__name__}({fields})"
+
+    def __getstate__(self) -> Tuple[Any, ...]:
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def __setstate__(self, state: Tuple[Any, ...]) -> None:
+        for field, value in zip(self.__slots__, state):
+            setattr(self, field, value)
+
+
+class UserRef(Record):
+    __slots__ = ("pk", "username")
+
+    pk: str
+    username: str
+
+    def __init__(self, pk: str, username: str) -> None:
+        self.pk = pk
+        self.username = username
+
+    @classmethod
+    def from_user_short(cls, user: UserShort) -> UserRef:
+        return cls(str(user.pk), str(user.username))
+
+
+class LocationRecord(Record):
+    __slots__ = ("pk", "name")
+
+    pk: Optional[int]
+    name: str
+
+    def __init__(self, pk: Optional[int], name: str) -> None:
+        self.pk = pk
+        self.name = name
+
+    @classmethod
+    def from_location(cls, location: Location) -> LocationRecord:
+        return cls(location.pk, location.name)
+
+
+class ResourceRecord(Record):
+    __slots__ = ("pk", "video_url", "thumbnail_url")
+
+    pk: str
+    video_url: Optional[str]
+    thumbnail_url: str
+
+    def __init__(self, pk: str, video_url: Optional[str], thumbnail_url: str) -> None:
+        self.pk = pk
+        self.video_url = video_url
+        self.thumbnail_url = thumbnail_url
+
+    @classmethod
+    def from_resource(cls, resource: Resource) -> ResourceRecord:
+        return cls(
+            str(resource.pk),
+            _optional_str(resource.video_url),
+            str(resource.thumbnail_url),
+        )
+
+
+class MediaRecord(Record):
+    __slots__ = (
+        "pk",
+        "code",
+        "media_type",
+        "user",
+        "title",
+        "video_url",
+        "thumbnail_url",
+        "resources",
+        "sponsor_tags",
+        "usertags",
+        "location",
+        "view_count",
+        "like_count",
+        "comment_count",
+        "taken_at",
+        "caption_text",
+    )
+
+    pk: str
+    code: str
+    media_type: int
+    user: UserRef
+    title: Optional[str]
+    video_url: Optional[str]
+    thumbnail_url: str
+    resources: Tuple[ResourceRecord, ...]
+    sponsor_tags: Tuple[UserRef, ...]
+    usertags: Tuple[UserRef, ...]
+    location: Optional[LocationRecord]
+    view_count: Optional[int]
+    like_count: int
+    comment_count: Optional[int]
+    taken_at: datetime
+    caption_text: Optional[str]
+
+    def __init__(self, **fields: Any) -> None:
+        for field in self.__slots__:
+            setattr(self, field, fields[field])
+
+    @classmethod
+    def from_media(cls, media: Media) -> MediaRecord:
+        return cls(
+            pk=str(media.pk),
+            code=media.code,
+            media_type=media.media_type,
+            user=UserRef.from_user_short(media.user),
+            title=media.title,
+            video_url=_optional_str(media.video_url),
+            # Albums don't always have a cover of their own
+            thumbnail_url=str(media.thumbnail_url or media.resources[0].thumbnail_url),
+            resources=tuple(map(ResourceRecord.from_resource, media.resources)),
+            sponsor_tags=tuple(map(UserRef.from_user_short, media.sponsor_tags)),
+            usertags=tuple(
+                UserRef.from_user_short(usertag.user) for usertag in media.usertags
+            ),
+            location=(
+                None
+                if media.location is None
+                else LocationRecord.from_location(media.location)
+            ),
+            view_count=media.view_count,
+            like_count=media.like_count,
+            comment_count=media.comment_count,
+            taken_at=media.taken_at,
+            caption_text=media.caption_text,
+        )
+
+
+class StoryRecord(Record):
+    __slots__ = (
+        "pk",
+        "media_type",
+        "user",
+        "video_url",
+        "thumbnail_url",
+        "taken_at",
+        "mentions",
+        "hashtags",
+    )
+
+    pk: str
+    media_type: int
+    user: UserRef
+    video_url: Optional[str]
+    thumbnail_url: str
+    taken_at: datetime
+    mentions: Tuple[UserRef, ...]
+    hashtags: Tuple[str, ...]
+
+    def __init__(self, **fields: Any) -> None:
+        for field in self.__slots__:
+            setattr(self, field, fields[field])
+
+    @classmethod
+    def from_story(cls, story: Story) -> StoryRecord:
+        return cls(
+            pk=str(story.pk),
+            media_type=story.media_type,
+            user=UserRef.from_user_short(story.user),
+            video_url=_optional_str(story.video_url),
+            thumbnail_url=str(story.thumbnail_url),
+            taken_at=story.taken_at,
+            mentions=tuple(
+                UserRef.from_user_short(mention.user) for mention in story.mentions
+            ),
+            hashtags=tuple(hashtag.hashtag.name for hashtag in story.hashtags),
+        )
+
+
+class ProfileRecord(Record):
+    __slots__ = (
+        "pk",
+        "username",
+        "full_name",
+        "profile_pic_url",
+        "media_count",
+        "follower_count",
+        "following_count",
+        "is_business",
+        "business_category_name",
+        "biography",
+        "external_url",
+    )
+
+    pk: str
+    username: str
+    full_name: str
+    profile_pic_url: str
+    media_count: int
+    follower_count: int
+    following_count: int
+    is_business: bool
+    business_category_name: Optional[str]
+    biography: Optional[str]
+    external_url: Optional[str]
+
+    def __init__(self, **fields: Any) -> None:
+        for field in self.__slots__:
+            setattr(self, field, fields[field])
+
+    @classmethod
+    def from_user(cls, user: User) -> ProfileRecord:
+        return cls(
+            pk=str(user.pk),
+            username=user.username,
+            full_name=user.full_name,
+            profile_pic_url=str(user.profile_pic_url),
+            media_count=user.media_count,
+            follower_count=user.follower_count,
+            following_count=user.following_count,
+            is_business=user.is_business,
+            business_category_name=user.business_category_name,
+            biography=user.biography,
+            external_url=user.external_url,
+        )
+
+
+class CommentRecord(Record):
+    __slots__ = ("pk", "user", "text", "like_count")
+
+    pk: str
+    user: UserRef
+    text: str
+    like_count: Optional[int]
+
+    def __init__(
+        self, pk: str, user: UserRef, text: str, like_count: Optional[int]
+    ) -> None:
+        self.pk = pk
+        self.user = user
+        self.text = text
+        self.like_count = like_count
+
+    @classmethod
+    def from_comment(cls, comment: Comment) -> CommentRecord:
+        return cls(
+            str(comment.pk),
+            UserRef.from_user_short(comment.user),
+            comment.text,
+            comment.like_count,
+        )
+
+
+class CommentPage(Record):
+    """A page of a post's comments, and the cursor the next page starts from"""
+
+    __slots__ = ("comments", "cursor")
+
+    comments: Tuple[CommentRecord, ...]
+    cursor: Optional[str]
+
+    def __init__(
+        self, comments: Tuple[CommentRecord, ...], cursor: Optional[str]
+    ) -> None:
+        self.comments = comments
+        self.cursor = cursor
+
+
+class SentMessages(Record):
+    """The messages in which a post was sent, so it can be copied rather than resent"""
+
+    __slots__ = ("chat_id", "message_ids", "media_group_id")
+
+    chat_id: int
+    message_ids: Tuple[int, ...]
+    media_group_id: Optional[str]
+
+    def __init__(
+        self, chat_id: int, message_ids: Tuple[int, ...], media_group_id: Optional[str]
+    ) -> None:
+        self.chat_id = chat_id
+        self.message_ids = message_ids
+        self.media_group_id = media_group_id
+
+
+def slim(convert: Callable[[M], R], model: M) -> R:
+    """Converts an instagrapi model to its record, logging both sizes at debug level"""
+    record = convert(model)
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(
+            "%s: %s bytes as a record, %s bytes as %s",
+            type(record).__name__,
+            deep_sizeof(record),
+            deep_sizeof(model),
+            type(model).__name__,
+        )
+    return record
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+import asyncio
+import time
+from collections import deque
+from enum import IntEnum
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+)
+
+from exceptions import Busy
+
+T = TypeVar("T")
+
+# Full token buckets are dropped once there are this many, at least
+BUCKET_PRUNE_THRESHOLD = 1024
+
+_Job = Tuple[Callable[[], Awaitable[Any]], "asyncio.Future[Any]", float]
+
+
+class TokenBucket:
+    """Allows `rate` requests per second on average, with bursts of up to `burst`"""
+
+    rate: float
+    burst: float
+    tokens: float
+    updated: float
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now: float) -> bool:
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class Priority(IntEnum):
+    """Scheduling classes, lower values are served first"""
+
+    INLINE = 0
+    COMMAND = 1
+    BULK = 2
+
+
+class _Lane:
+    """Per-user round-robin queues of a single priority class"""
+
+    queues: Dict[int, Deque[_Job]]
+    order: Deque[int]
+
+    def __init__(self) -> None:
+        self.queues = {}
+        self.order = deque()
+
+    def __len__(self) -> int:
+        # Cancelled jobs stay queued until their turn comes, but don't count
+        return sum(
+            1 for queue in self.queues.values() for job in queue if not job[1].done()
+        )
+
+    def append(self, user_id: int, job: _Job) -> None:
+        if user_id not in self.queues:
+            self.queues[user_id] = deque()
+            self.order.append(user_id)
+        self.queues[user_id].append(job)
+
+    def oldest(self) -> Optional[float]:
+        """Returns when the longest waiting job in this lane was queued"""
+        return min(
+            (queue[0][2] for queue in self.queues.values() if queue), default=None
+        )
+
+    def next_job(
+        self, now: float, bucket: Callable[[int], Optional[TokenBucket]]
+    ) -> Tuple[Optional[_Job], Optional[float]]:
+        """
+        Returns the next user's job in round-robin order,
+        or how long to wait until a rate limited user may run again.
+        """
+        wait: Optional[float] = None
+        for _ in range(len(self.order)):
+            user_id = self.order.popleft()
+            queue = self.queues[user_id]
+            while queue and queue[0][1].done():
+                queue.popleft()
+            if not queue:
+                del self.queues[user_id]
+                continue
+            self.order.append(user_id)
+            user_bucket = bucket(user_id)
+            if user_bucket is not None and not user_bucket.take(now):
+                user_wait = user_bucket.wait_time(now)
+                wait = user_wait if wait is None else min(wait, user_wait)
+                continue
+            return queue.popleft(), None
+        return None, wait
+
+
+class FairScheduler:
+    """
+    Runs jobs with bounded concurrency, serving higher priority classes first
+    and taking turns between users so that one heavy user cannot starve the others.
+    Each user is also limited by their own token bucket,
+    and users given a limit of their own by it, even without `user_rate`.
+    A job that waited longer than `starvation_timeout` is served regardless of priority.
+    Once `max_depth` jobs are waiting, new ones are shed at once by raising Busy.
+    """
+
+    concurrency: int
+    max_depth: Optional[int]
+    shed: int
+    user_rate: Optional[float]
+    user_burst: float
+    starvation_timeout: float
+    _lanes: Dict[Priority, _Lane]
+    _buckets: Dict[int, TokenBucket]
+    _limits: Dict[int, TokenBucket]
+    _prune_at: int
+    _slots: asyncio.Semaphore
+    _wakeup: asyncio.Event
+    _dispatcher: Optional["asyncio.Task[None]"]
+    _running: Set["asyncio.Task[None]"]
+
+    def __init__(
+        self,
+        concurrency: int = 1,
+        user_rate: Optional[float] = None,
+        user_burst: float = 5,
+        starvation_timeout: float = 10,
+        max_depth: Optional[int] = None,
+    ) -> None:
+        self.concurrency = concurrency
+        self.max_depth = max_depth
+        self.shed = 0
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.starvation_timeout = starvation_timeout
+        self._lanes = {priority: _Lane() for priority in Priority}
+        self._buckets = {}
+        self._limits = {}
+        self._prune_at = BUCKET_PRUNE_THRESHOLD
+        self._slots = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+        self._running = set()
+
+    def __len__(self) -> int:
+        return sum(len(lane) for lane in self._lanes.values())
+
+    @property
+    def running(self) -> int:
+        return len(self._running)
+
+    def depths(self) -> Dict[Priority, int]:
+        """Returns how many jobs are waiting in each priority class"""
+        return {priority: len(lane) for priority, lane in self._lanes.items()}
+
+    async def submit(
+        self,
+        user_id: int,
+        func: Callable[[], Awaitable[T]],
+        priority: Priority = Priority.COMMAND,
+    ) -> T:
+        """
+        Queues a job for a user and waits for its result.
+        Cancelling the wait, e.g. when its deadline passes, drops the job from
+        its queue. A job that already runs keeps its slot until it finishes,
+        as the thread it may run in can't be stopped, and only its waiter is dropped.
+        """
+        if self.max_depth is not None:
+            depth = len(self)
+            if depth >= self.max_depth:
+                self.shed += 1
+                raise Busy(depth)
+        future: "asyncio.Future[T]" = asyncio.get_running_loop().create_future()
+        self._lanes[priority].append(user_id, (func, future, time.monotonic()))
+        self._wakeup.set()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        return await future
+
+    def limit(self, user_id: int, rate: float, burst: float) -> None:
+        """Limits a user to their own rate, e.g. one running in the background"""
+        self._limits[user_id] = TokenBucket(rate, burst)
+
+    def _bucket(self, user_id: int) -> Optional[TokenBucket]:
+        if user_id in self._limits:
+            return self._limits[user_id]
+        if self.user_rate is None:
+            return None
+        if user_id not in self._buckets:
+            if len(self._buckets) >= self._prune_at:
+                self._prune_buckets()
+            self._buckets[user_id] = TokenBucket(self.user_rate, self.user_burst)
+        return self._buckets[user_id]
+
+    def _prune_buckets(self) -> None:
+        """
+        Drops the buckets that refilled completely, as a new one would be the same.
+        Pruning again waits until there are twice as many, so it stays cheap.
+        """
+        now = time.monotonic()
+        self._buckets = {
+            user_id: bucket
+            for user_id, bucket in self._buckets.items()
+            if not bucket.is_full(now)
+        }
+        self._prune_at = max(BUCKET_PRUNE_THRESHOLD, 2 * len(self._buckets))
+
+    def _next_job(self, now: float) -> Tuple[Optional[_Job], Optional[float]]:
+        lanes = list(self._lanes.values())
+        # Starving lanes go first, oldest job first
+        starving = [
+            (oldest, lane)
+            for lane in lanes
+            if (oldest := lane.oldest()) is not None
+            and now - oldest > self.starvation_timeout
+        ]
+        starving.sort(key=lambda item: item[0])
+        wait: Optional[float] = None
+        for lane in [lane for _, lane in starving] + lanes:
+            job, lane_wait = lane.next_job(now, self._bucket)
+            if job is not None:
+                return job, None
+            if lane_wait is not None:
+                wait = lane_wait if wait is None else min(wait, lane_wait)
+        return None, wait
+
+    async def _dispatch(self) -> None:
+        while True:
+            await self._slots.acquire()
+            job, wait = self._next_job(time.monotonic())
+            while job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                job, wait = self._next_job(time.monotonic())
+            task = asyncio.create_task(self._run(job))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, job: _Job) -> None:
+        func, future, _ = job
+        try:
+            if future.done():
+                return
+            result = await func()
+            if not future.done():
+                future.set_result(result)
+        except asyncio.CancelledError:
+            # The runner itself is being cancelled, e.g. at shutdown
+            if not future.done():
+                future.cancel()
+            raise
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            self._slots.release()
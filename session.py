@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+import asyncio
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+from instagrapi import Client
+from instagrapi.exceptions import LoginRequired
+
+from login import (
+    SESSION_PATH,
+    env_credentials,
+    login_with_credentials,
+    validate_session,
+)
+
+T = TypeVar("T")
+
+KEEPALIVE_INTERVAL = 30 * 60
+
+
+class SessionManager:
+    """
+    Owns the Instagram client's session: persists it in the background,
+    and re-logs-in once without prompting when a request hits LoginRequired.
+    """
+
+    client: Client
+    username: Optional[str]
+    settings_path: Path
+    _client_lock: threading.Lock
+    _generation: int
+    _relogin_task: Optional["asyncio.Task[None]"]
+    _session_ok: asyncio.Event
+
+    def __init__(
+        self,
+        client: Client,
+        username: Optional[str],
+        settings_path: Path = SESSION_PATH,
+    ) -> None:
+        self.client = client
+        self.username = username
+        self.settings_path = settings_path
+        self._client_lock = threading.Lock()
+        self._generation = 0
+        self._relogin_task = None
+        self._session_ok = asyncio.Event()
+        self._session_ok.set()
+
+    def _relogin(self) -> None:
+        if self.username is None:
+            raise LoginRequired("Instagram requires a login, run the bot with --user")
+        password, totp_seed = env_credentials()
+        if password is None:
+            raise LoginRequired("Session expired and IG_PASSWORD is not set")
+
+        old_session = self.client.get_settings()
+
+        # use the same device uuids across logins
+        self.client.set_settings({})
+        self.client.set_uuids(old_session["uuids"])
+
+        if not login_with_credentials(self.client, self.username, password, totp_seed):
+            raise LoginRequired("Could not re-login to Instagram")
+        self.client.dump_settings(self.settings_path)
+
+    async def _relogin_in_background(self) -> None:
+        try:
+            logging.info("Instagram session expired, logging in again")
+            await self.in_thread(self._relogin)
+            self._generation += 1
+        finally:
+            self._relogin_task = None
+            self._session_ok.set()
+
+    async def relogin(self, failed_generation: int) -> None:
+        """
+        Re-logs-in, unless another request already did so since failed_generation,
+        or joins the re-login in progress.
+        Requests made meanwhile wait for the new session.
+        The login runs on even if the request that started it gives up waiting,
+        as its thread can't be stopped, so no second one starts on the same client.
+        """
+        if self._generation != failed_generation:
+            return
+        if self._relogin_task is None:
+            self._session_ok.clear()
+            self._relogin_task = asyncio.create_task(self._relogin_in_background())
+            # Retrieved here in case every request waiting for it gave up
+            self._relogin_task.add_done_callback(
+                lambda task: task.cancelled() or task.exception()
+            )
+        await asyncio.shield(self._relogin_task)
+
+    async def run(
+        self, func: Callable[..., Awaitable[T]], *args: Any, **kwargs: Any
+    ) -> T:
+        """
+        Awaits a client call.
+        On LoginRequired the session is renewed and the call retried a single time.
+        """
+        await self._session_ok.wait()
+        generation = self._generation
+        try:
+            return await func(*args, **kwargs)
+        except LoginRequired:
+            await self.relogin(generation)
+            return await func(*args, **kwargs)
+
+    def _locked(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        with self._client_lock:
+            return func(*args, **kwargs)
+
+    async def in_thread(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """
+        Runs a blocking client call in a thread, one at a time,
+        as the client keeps each response in state shared by all of its calls.
+        Only the HTTP/2 transport's lookups run in parallel.
+        """
+        return await asyncio.to_thread(self._locked, func, *args, **kwargs)
+
+    async def call(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Runs a blocking client call in a thread, see `run` and `in_thread`"""
+        return await self.run(self.in_thread, func, *args, **kwargs)
+
+    def _refresh(self) -> bool:
+        valid = validate_session(self.client)
+        if valid:
+            self.client.dump_settings(self.settings_path)
+        return valid
+
+    async def keepalive(self, interval: float = KEEPALIVE_INTERVAL) -> None:
+        """Periodically checks the session and persists refreshed cookies"""
+        if self.username is None:
+            return
+        while True:
+            await asyncio.sleep(interval)
+            generation = self._generation
+            try:
+                if not await self.in_thread(self._refresh):
+                    await self.relogin(generation)
+            except Exception:
+                logging.exception("Instagram session keepalive failed")
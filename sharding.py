@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+import logging
+import multiprocessing
+import queue
+import time
+import zlib
+from logging.handlers import QueueListener
+from multiprocessing.context import SpawnProcess
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from telegram import Update
+from telegram.ext import Application, CallbackContext, TypeHandler
+
+from authorization import Authorizer
+from structured_logging import (
+    ForwardingQueueHandler,
+    configure_logging,
+    payload_sample_rate,
+    receive_logging,
+)
+
+HEARTBEAT_INTERVAL = 5
+HEARTBEAT_TIMEOUT = 30
+HEALTH_CHECK_INTERVAL = 10
+# Commands whose argument is a username rather than a shortcode or an ID
+USERNAME_COMMANDS = frozenset({"profile", "watch", "unwatch"})
+
+_context = multiprocessing.get_context("spawn")
+
+
+def rendezvous(key: str, indexes: Iterable[int]) -> int:
+    """Returns the index of the worker with the highest hash for a key"""
+    return max(indexes, key=lambda index: zlib.crc32(f"{index}:{key}".encode()))
+
+
+def normalize_key(value: str, is_username: bool) -> str:
+    """
+    Returns the one form an entry is routed by, whichever update asks for it:
+    usernames without their @ and in lower case, as Instagram ignores their case,
+    shortcodes and IDs as they are, as shortcodes are case-sensitive
+    """
+    value = value.strip().lstrip("@")
+    return value.lower() if is_username else value
+
+
+def route_key(update: Update) -> str:
+    """
+    Returns the key an update is routed by:
+    the shortcode, ID or username it asks for, otherwise the chat it came from.
+    """
+    if update.inline_query is not None:
+        return normalize_key(update.inline_query.query, is_username=False)
+    if update.callback_query is not None and update.callback_query.data is not None:
+        # All pages of a post's comments go to the worker that cached the earlier ones
+        return update.callback_query.data.split(":")[1]
+    if update.message is not None and update.message.text is not None:
+        words = update.message.text.split()
+        if len(words) > 1:
+            command = words[0].lstrip("/").partition("@")[0].lower()
+            return normalize_key(words[1], command in USERNAME_COMMANDS)
+    if update.effective_chat is not None:
+        return str(update.effective_chat.id)
+    return str(update.update_id)
+
+
+async def _heartbeat(heartbeat: Any) -> None:
+    while True:
+        heartbeat.value = time.time()
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+
+async def _serve(
+    token: str,
+    index: int,
+    whitelist: Optional[Set[int]],
+    handler_kwargs: Dict[str, Any],
+    updates: "multiprocessing.Queue[Optional[Tuple[str, str]]]",
+    heartbeat: Any,
+) -> None:
+    from bot import CONCURRENT_UPDATES, add_handlers
+    from error_handler import ErrorHandler
+    from instagram import InstagramHandler
+
+    record_path = handler_kwargs.get("record_path")
+    if record_path is not None:
+        # Workers appending to one gzip file would interleave their writes
+        handler_kwargs = {
+            **handler_kwargs,
+            "record_path": record_path.with_name(f"{record_path.name}.{index}"),
+        }
+    metrics_port = handler_kwargs.get("metrics_port")
+    if metrics_port is not None:
+        handler_kwargs = {**handler_kwargs, "metrics_port": metrics_port + index}
+
+    with InstagramHandler(
+        **handler_kwargs,
+        session_path=Path(f"session.{index}.json"),
+        # /watch is routed by username, so each worker checks the accounts it was given
+        watch_path=Path(f"watches.{index}.json"),
+    ) as instagram_handler, ErrorHandler(whitelist) as error_handler:
+        application = (
+            Application.builder()
+            .token(token)
+            .updater(None)
+            .concurrent_updates(CONCURRENT_UPDATES)
+            .build()
+        )
+        add_handlers(application, instagram_handler, error_handler, whitelist)
+
+        async with application:
+            await application.start()
+            await instagram_handler.start(application)
+            heartbeat_task = asyncio.create_task(_heartbeat(heartbeat))
+            while (item := await asyncio.to_thread(updates.get)) is not None:
+                _, data = item
+                await application.update_queue.put(
+                    Update.de_json(json.loads(data), application.bot)
+                )
+            heartbeat_task.cancel()
+            await application.stop()
+            await instagram_handler.stop(application)
+
+
+def worker_main(
+    token: str,
+    index: int,
+    whitelist: Optional[Set[int]],
+    handler_kwargs: Dict[str, Any],
+    updates: "multiprocessing.Queue[Optional[Tuple[str, str]]]",
+    heartbeat: Any,
+    logs: "multiprocessing.Queue[Optional[logging.LogRecord]]",
+    log_level: int,
+    log_sample_rate: float,
+) -> None:
+    """Entry point of a worker process"""
+    # Emitted by the router's handlers, so workers log like the router does
+    log_handler = ForwardingQueueHandler(logs)
+    log_handler.setFormatter(logging.Formatter(f"worker {index} - %(message)s"))
+    log_listener = configure_logging(
+        [log_handler], log_level, payload_sample_rate=log_sample_rate
+    )
+    try:
+        asyncio.run(_serve(token, index, whitelist, handler_kwargs, updates, heartbeat))
+    finally:
+        log_listener.stop()
+
+
+class Worker:
+    index: int
+    process: SpawnProcess
+    updates: "multiprocessing.Queue[Optional[Tuple[str, str]]]"
+    heartbeat: Any
+
+    def __init__(self, index: int) -> None:
+        self.index = index
+        self.updates = _context.Queue()
+        self.heartbeat = _context.Value("d", time.time())
+
+    def start(
+        self,
+        token: str,
+        whitelist: Optional[Set[int]],
+        handler_kwargs: Dict[str, Any],
+        logs: "multiprocessing.Queue[Optional[logging.LogRecord]]",
+    ) -> None:
+        self.heartbeat.value = time.time()
+        self.process = _context.Process(
+            target=worker_main,
+            args=(
+                token,
+                self.index,
+                whitelist,
+                handler_kwargs,
+                self.updates,
+                self.heartbeat,
+                logs,
+                logging.getLogger().getEffectiveLevel(),
+                payload_sample_rate(),
+            ),
+            name=f"IgTgBot worker {self.index}",
+            daemon=True,
+        )
+        self.process.start()
+
+    def is_healthy(self) -> bool:
+        return (
+            self.process.is_alive()
+            and time.time() - self.heartbeat.value < HEARTBEAT_TIMEOUT
+        )
+
+    def drain(self) -> List[Tuple[str, str]]:
+        """Removes and returns the updates a worker did not get to"""
+        pending: List[Tuple[str, str]] = []
+        while True:
+            try:
+                item = self.updates.get_nowait()
+            except queue.Empty:
+                return pending
+            if item is not None:
+                pending.append(item)
+
+
+class ShardRouter:
+    """
+    Sends updates to worker processes by rendezvous hashing of their route key,
+    so repeat requests reach the worker whose caches are already warm,
+    and only the keys of a dead worker move elsewhere.
+    """
+
+    token: str
+    whitelist: Optional[Set[int]]
+    handler_kwargs: Dict[str, Any]
+    workers: List[Worker]
+    logs: "multiprocessing.Queue[Optional[logging.LogRecord]]"
+    _healthy: Set[int]
+    _log_listener: Optional[QueueListener]
+
+    def __init__(
+        self,
+        token: str,
+        count: int,
+        whitelist: Optional[Set[int]],
+        handler_kwargs: Dict[str, Any],
+    ) -> None:
+        self.token = token
+        self.whitelist = whitelist
+        self.handler_kwargs = handler_kwargs
+        self.workers = [Worker(index) for index in range(count)]
+        self.logs = _context.Queue()
+        self._healthy = set()
+        self._log_listener = None
+
+    def _worker_kwargs(self, worker: Worker) -> Dict[str, Any]:
+        if "warm_path" not in self.handler_kwargs:
+            return self.handler_kwargs
+        # Each worker warms the entries the router would send it
+        return {**self.handler_kwargs, "warm_shard": (worker.index, len(self.workers))}
+
+    def start(self) -> None:
+        self._log_listener = receive_logging(self.logs)
+        for worker in self.workers:
+            worker.start(
+                self.token, self.whitelist, self._worker_kwargs(worker), self.logs
+            )
+            self._healthy.add(worker.index)
+
+    def stop(self) -> None:
+        for worker in self.workers:
+            worker.updates.put(None)
+        for worker in self.workers:
+            worker.process.join(timeout=10)
+            if worker.process.is_alive():
+                worker.process.terminate()
+        if self._log_listener is not None:
+            self._log_listener.stop()
+
+    def pick(self, key: str) -> Worker:
+        indexes = self._healthy or range(len(self.workers))
+        return self.workers[rendezvous(key, indexes)]
+
+    def _send(self, key: str, data: str) -> None:
+        self.pick(key).updates.put((key, data))
+
+    async def dispatch(self, update: object, context: CallbackContext) -> None:
+        if not isinstance(update, Update):
+            return
+        self._send(route_key(update), update.to_json())
+
+    def check_health(self) -> None:
+        """Restarts dead or stuck workers and re-routes the updates they held"""
+        for worker in self.workers:
+            if worker.is_healthy():
+                self._healthy.add(worker.index)
+                continue
+            logging.warning("Worker %s is unhealthy, restarting it", worker.index)
+            self._healthy.discard(worker.index)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            for key, data in worker.drain():
+                self._send(key, data)
+            worker.start(
+                self.token, self.whitelist, self._worker_kwargs(worker), self.logs
+            )
+
+    async def monitor(self) -> None:
+        while True:
+            await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+            self.check_health()
+
+
+def run_sharded(
+    token: str,
+    count: int,
+    whitelist: Optional[Set[int]],
+    handler_kwargs: Dict[str, Any],
+    webhook_url: Optional[str] = None,
+    webhook_port: int = 8443,
+) -> None:
+    """Receives updates in this process and hands them to `count` worker processes"""
+    from bot import run_application
+
+    router = ShardRouter(token, count, whitelist, handler_kwargs)
+
+    async def post_init(application: Application) -> None:
+        application.create_task(router.monitor())
+
+    async def post_shutdown(application: Application) -> None:
+        router.stop()
+
+    application = (
+        Application.builder()
+        .token(token)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    # Unauthorized updates are rejected here, before they reach a worker
+    application.add_handler(TypeHandler(Update, Authorizer(whitelist).check), group=-1)
+    application.add_handler(TypeHandler(Update, router.dispatch))
+
+    router.start()
+    run_application(application, webhook_url, webhook_port)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+import logging
+import time
+from importlib import import_module
+from types import ModuleType
+from typing import Dict
+
+_process_start: float = time.perf_counter()
+
+
+class StartupReport:
+    """Records how long each phase of startup took, relative to process start"""
+
+    marks: Dict[str, float]
+    imports: Dict[str, float]
+
+    def __init__(self) -> None:
+        self.marks = {}
+        self.imports = {}
+
+    def mark(self, name: str) -> None:
+        self.marks[name] = time.perf_counter() - _process_start
+
+    def timed_import(self, name: str) -> ModuleType:
+        """Imports a module, recording how long the import took"""
+        start = time.perf_counter()
+        module = import_module(name)
+        self.imports.setdefault(name, time.perf_counter() - start)
+        return module
+
+    def log(self) -> None:
+        for name, elapsed in sorted(self.marks.items(), key=lambda item: item[1]):
+            logging.info("Startup: %s after %.3f s", name, elapsed)
+        for name, elapsed in self.imports.items():
+            logging.info("Startup: import %s took %.3f s", name, elapsed)
+
+
+startup_report = StartupReport()
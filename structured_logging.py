@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+import json
+import logging
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, List, Optional, Tuple
+
+SUMMARY_FIELDS: Tuple[str, ...] = (
+    "pk",
+    "code",
+    "username",
+    "message_id",
+    "id",
+    "query",
+    "text",
+)
+
+_payload_sample_rate: float = 0.0
+
+
+class Payload:
+    """Defers formatting of a large object until a handler actually emits it"""
+
+    __slots__ = ("obj", "full")
+
+    def __init__(self, obj: Any, full: bool) -> None:
+        self.obj = obj
+        self.full = full
+
+    def summary(self) -> Dict[str, Any]:
+        summary: Dict[str, Any] = {"type": type(self.obj).__qualname__}
+        for field in SUMMARY_FIELDS:
+            value = getattr(self.obj, field, None)
+            if value is not None:
+                summary[field] = str(value)
+        return summary
+
+    def __str__(self) -> str:
+        if self.full:
+            return str(getattr(self.obj, "__dict__", self.obj))
+        return str(self.summary())
+
+
+class DeferredQueueHandler(QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        output: Dict[str, Any] = {
+            "time": self.formatTime(record),
+            "logger": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        payload = getattr(record, "payload", None)
+        if isinstance(payload, Payload):
+            output["payload"] = str(payload) if payload.full else payload.summary()
+        if record.exc_info:
+            output["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(output, default=str, ensure_ascii=False)
+
+
+class PayloadFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        message = super().format(record)
+        payload = getattr(record, "payload", None)
+        if isinstance(payload, Payload):
+            message = f"{message} {payload!s}"
+        return message
+
+
+def log_payload(label: str, obj: Any, level: int = logging.INFO) -> None:
+    """
+    Logs an object without stringifying it on the calling thread.
+    The full object is only logged at debug level or for a sampled fraction of calls.
+    """
+    root = logging.getLogger()
+    if not root.isEnabledFor(level):
+        return
+    full = root.isEnabledFor(logging.DEBUG) or (
+        _payload_sample_rate > 0 and random.random() < _payload_sample_rate
+    )
+    root.log(level, label, extra={"payload": Payload(obj, full)})
+
+
+def configure_logging(
+    handlers: List[logging.Handler],
+    level: int,
+    json_handlers: Optional[List[logging.Handler]] = None,
+    payload_sample_rate: float = 0.0,
+) -> QueueListener:
+    """
+    Routes all logging through a queue to a listener thread so that formatting and
+    I/O never happen on the event loop. The returned listener is already started.
+    """
+    global _payload_sample_rate
+    _payload_sample_rate = payload_sample_rate
+
+    if json_handlers is None:
+        json_handlers = []
+
+    for handler in handlers:
+        if handler.formatter is None:
+            handler.setFormatter(
+                PayloadFormatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+            )
+    for handler in json_handlers:
+        handler.setFormatter(JsonFormatter())
+
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    listener = QueueListener(
+        log_queue, *handlers, *json_handlers, respect_handler_level=True
+    )
+
+    logging.basicConfig(
+        level=level,
+        handlers=[DeferredQueueHandler(log_queue)],
+        force=True,
+    )
+    listener.start()
+    return listener
+
+
+def payload_sample_rate() -> float:
+    return _payload_sample_rate
+
+
+class RenderedPayload(Payload):
+    """A payload rendered where it was logged, so it can be sent to another process"""
+
+    __slots__ = ("text", "fields")
+
+    def __init__(self, payload: Payload) -> None:
+        super().__init__(None, payload.full)
+        self.text = str(payload)
+        self.fields = payload.summary()
+
+    def summary(self) -> Dict[str, Any]:
+        return self.fields
+
+    def __str__(self) -> str:
+        return self.text
+
+
+class ForwardingQueueHandler(QueueHandler):
+    """
+    Sends records to another process, with their messages and payloads rendered.
+    Its formatter only renders the message, the receiving handlers format the rest.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = super().prepare(record)
+        payload = getattr(record, "payload", None)
+        if isinstance(payload, Payload):
+            record.payload = RenderedPayload(payload)
+        return record
+
+
+class _LoggerDispatcher(logging.Handler):
+    def emit(self, record: logging.LogRecord) -> None:
+        logging.getLogger(record.name).handle(record)
+
+
+def receive_logging(log_queue: Any) -> QueueListener:
+    """Emits the records of worker processes as if they were logged here"""
+    listener = QueueListener(log_queue, _LoggerDispatcher())
+    listener.start()
+    return listener
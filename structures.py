@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
-from typing import Optional, Set
+import sys
+from typing import Any, Optional, Set
 from unicodedata import normalize as _uni_normalize
 
 
@@ -33,3 +34,28 @@ def optional_normalize(string: Optional[str]) -> Optional[str]:
         return normalize(string)
     else:
         return None
+
+
+def deep_sizeof(obj: Any) -> int:
+    """Returns the memory used by an object and everything it references"""
+    seen: Set[int] = set()
+    size = 0
+    pending = [obj]
+    while pending:
+        current = pending.pop()
+        if id(current) in seen or isinstance(current, type):
+            continue
+        seen.add(id(current))
+        size += sys.getsizeof(current)
+        if isinstance(current, dict):
+            pending.extend(current.keys())
+            pending.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            pending.extend(current)
+        if hasattr(current, "__dict__"):
+            pending.append(current.__dict__)
+        for cls in type(current).__mro__:
+            for slot in getattr(cls, "__slots__", ()):
+                if isinstance(slot, str) and hasattr(current, slot):
+                    pending.append(getattr(current, slot))
+    return size
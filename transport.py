@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+import asyncio
+import logging
+import random
+import time
+from typing import TYPE_CHECKING, Any, Dict, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+if TYPE_CHECKING:
+    from instagrapi import Client
+    from instagrapi.types import Media, User
+
+MAX_CONNECTIONS = 20
+MAX_KEEPALIVE_CONNECTIONS = 10
+KEEPALIVE_EXPIRY = 60
+MAX_PER_HOST = 8
+TIMEOUT = 15
+
+# Headers instagrapi sends for HTTP/1.1 that are not allowed or handled by httpx
+_DROPPED_HEADERS = {"connection", "host", "accept-encoding", "content-length"}
+
+
+def response_error(
+    status_code: int, last_json: Dict[str, Any], url: str
+) -> Optional[Exception]:
+    """Returns the exception instagrapi would raise for a private API response"""
+    from instagrapi import exceptions
+
+    if 200 <= status_code < 300:
+        if not last_json:
+            return exceptions.ClientJSONDecodeError(
+                f"Could not decode the response of {url}"
+            )
+        return None
+
+    message = last_json.get("message", "")
+    if "Please wait a few minutes" in message:
+        return exceptions.PleaseWaitFewMinutes(**last_json)
+    if status_code == 403:
+        if message == "login_required":
+            return exceptions.LoginRequired(**last_json)
+        return exceptions.ClientForbiddenError(**last_json)
+    if status_code == 400:
+        if message == "challenge_required":
+            return exceptions.ChallengeRequired(**last_json)
+        if message == "feedback_required":
+            return exceptions.FeedbackRequired(**last_json)
+        if last_json.get("error_type") == "rate_limit_error":
+            return exceptions.RateLimitError(**last_json)
+        return exceptions.ClientBadRequestError(**last_json)
+    if status_code == 404:
+        return exceptions.ClientNotFoundError(**last_json)
+    if status_code == 429:
+        return exceptions.ClientThrottledError(**last_json)
+    return exceptions.ClientError(f"{status_code} response from {url}", **last_json)
+
+
+class AsyncInstagramTransport:
+    """
+    Performs private API lookups on the event loop instead of in a thread,
+    over one httpx HTTP/2 connection pool shared by all of them.
+    Requests carry the headers and cookies of the instagrapi client's session,
+    and responses are parsed with instagrapi's own extractors.
+    """
+
+    max_per_host: int
+    _client: httpx.AsyncClient
+    _hosts: Dict[str, asyncio.Semaphore]
+
+    def __init__(
+        self,
+        max_connections: int = MAX_CONNECTIONS,
+        max_keepalive_connections: int = MAX_KEEPALIVE_CONNECTIONS,
+        max_per_host: int = MAX_PER_HOST,
+    ) -> None:
+        self.max_per_host = max_per_host
+        self._client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+            ),
+            timeout=TIMEOUT,
+        )
+        self._hosts = {}
+
+    def _host_slots(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        if host not in self._hosts:
+            self._hosts[host] = asyncio.Semaphore(self.max_per_host)
+        return self._hosts[host]
+
+    @staticmethod
+    def _headers(client: "Client") -> Dict[str, str]:
+        headers = {**client.private.headers, **client.base_headers}
+        if client.authorization:
+            headers["Authorization"] = client.authorization
+        return {
+            key: str(value)
+            for key, value in headers.items()
+            if value is not None and key.lower() not in _DROPPED_HEADERS
+        }
+
+    async def private_request(
+        self, client: "Client", endpoint: str, params: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """GETs a private API endpoint, raising the exceptions instagrapi would"""
+        from instagrapi import config
+
+        from corpus import RecordingClient, ReplayClient
+
+        if isinstance(client, ReplayClient):
+            return await client.private_request_async(endpoint, params)
+        if client.delay_range:
+            await asyncio.sleep(random.uniform(*client.delay_range))
+        url = f"https://{client.domain or config.API_DOMAIN}/api/v1/{endpoint}"
+        async with self._host_slots(url):
+            start = time.perf_counter()
+            response = await self._client.get(
+                url,
+                params=params,
+                headers=self._headers(client),
+                cookies=dict(client.private.cookies),
+            )
+            latency = time.perf_counter() - start
+        logging.debug("%s %s %s", response.http_version, response.status_code, url)
+        mid = response.headers.get("ig-set-x-mid")
+        if mid:
+            client.mid = mid
+
+        try:
+            last_json = response.json()
+        except ValueError:
+            last_json = {}
+        # Unlike instagrapi, the response isn't kept in client.last_json,
+        # which the calls running in a thread read their own responses from
+        error = response_error(response.status_code, last_json, url)
+        if isinstance(client, RecordingClient):
+            client.corpus.record(
+                "private",
+                endpoint,
+                params,
+                latency,
+                last_json,
+                error,
+                response.status_code,
+                last_json,
+            )
+        if error is not None:
+            raise error
+        return last_json
+
+    async def media_info(self, client: "Client", media_pk: str) -> "Media":
+        from instagrapi.exceptions import ClientNotFoundError, MediaNotFound
+        from instagrapi.extractors import extract_media_v1
+
+        try:
+            result = await self.private_request(client, f"media/{media_pk}/info/")
+        except ClientNotFoundError as e:
+            raise MediaNotFound(e, media_pk=media_pk) from e
+        return extract_media_v1(result["items"].pop())
+
+    async def user_info(self, client: "Client", user_id: str) -> "User":
+        from instagrapi.exceptions import ClientNotFoundError, UserNotFound
+        from instagrapi.extractors import extract_user_v1
+
+        try:
+            result = await self.private_request(client, f"users/{user_id}/info/")
+        except ClientNotFoundError as e:
+            raise UserNotFound(e, user_id=user_id) from e
+        return extract_user_v1(result["user"])
+
+    async def user_info_by_username(self, client: "Client", username: str) -> "User":
+        from instagrapi.exceptions import ClientNotFoundError, UserNotFound
+        from instagrapi.extractors import extract_user_v1
+
+        username = username.lower()
+        try:
+            result = await self.private_request(
+                client, f"users/{username}/usernameinfo/"
+            )
+        except ClientNotFoundError as e:
+            raise UserNotFound(e, username=username) from e
+        return extract_user_v1(result["user"])
+
+    async def download(self, url: str) -> bytes:
+        """Downloads a file, such as an image from Instagram's CDN, through the pool"""
+        async with self._host_slots(url):
+            response = await self._client.get(url)
+        response.raise_for_status()
+        return response.content
+
+    async def close(self) -> None:
+        await self._client.aclose()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import asyncio
+import logging
+import re
+from pathlib import Path
+from typing import TYPE_CHECKING, Awaitable, Callable, List, Optional, Tuple, TypeVar
+
+from telegram.ext import Application
+
+from exceptions import Busy, CircuitOpen
+from scheduler import Priority
+from sharding import normalize_key, rendezvous
+
+if TYPE_CHECKING:
+    from instagram import InstagramHandler
+
+T = TypeVar("T")
+
+# Scheduler user the prefetches are queued under, apart from the watcher's checks
+WARMER_USER_ID = -1
+# How long to back off while live requests fill the lookup queue
+BUSY_BACKOFF = 5
+# Lookups per second the prefetches are limited to, whatever --user-rate says
+WARM_RATE = 0.5
+WARM_BURST = 1
+
+_POST_URL = re.compile(r"instagram\.com/(?:p|reel|tv)/([\w-]+)")
+_PROFILE_URL = re.compile(r"instagram\.com/([\w.]+)")
+
+
+def parse_warm_list(text: str) -> List[Tuple[str, str]]:
+    """
+    Returns the ("username", name) and ("shortcode", code) entries of a list.
+    Each line holds an @username, a shortcode, or the URL of a profile or post.
+    Blank lines and lines starting with # are skipped.
+    """
+    entries: List[Tuple[str, str]] = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line == "" or line.startswith("#"):
+            continue
+        if (match := _POST_URL.search(line)) is not None:
+            entries.append(("shortcode", match.group(1)))
+        elif (match := _PROFILE_URL.search(line)) is not None:
+            entries.append(("username", match.group(1).lower()))
+        elif line.startswith("@"):
+            entries.append(("username", line[1:].lower()))
+        else:
+            entries.append(("shortcode", line))
+    return entries
+
+
+class CacheWarmer:
+    """
+    Prefetches the profiles and latest posts of popular accounts, and popular
+    posts, after a start, so their first requests are served from the cache.
+    Lookups run one at a time at bulk priority under a rate limit of their own,
+    and back off while live requests fill the queue.
+    With worker processes, each warms the entries routed to it.
+    """
+
+    handler: InstagramHandler
+    path: Path
+    posts: int
+    shard: Optional[Tuple[int, int]]
+
+    def __init__(
+        self,
+        handler: InstagramHandler,
+        path: Path,
+        posts: int = 12,
+        shard: Optional[Tuple[int, int]] = None,
+    ) -> None:
+        self.handler = handler
+        self.path = path
+        self.posts = posts
+        self.shard = shard
+
+    def start(self, application: Application) -> None:
+        self.handler.fetcher.scheduler.limit(WARMER_USER_ID, WARM_RATE, WARM_BURST)
+        application.create_task(self.run())
+
+    def _is_mine(self, kind: str, value: str) -> bool:
+        if self.shard is None:
+            return True
+        index, count = self.shard
+        # The same key the router sends a request for this entry by
+        key = normalize_key(value, is_username=kind == "username")
+        return rendezvous(key, range(count)) == index
+
+    async def _retry(self, func: Callable[[], Awaitable[T]]) -> T:
+        """Runs a lookup, waiting out a busy queue or a throttling Instagram"""
+        while True:
+            try:
+                return await func()
+            except Busy:
+                await asyncio.sleep(BUSY_BACKOFF)
+            except CircuitOpen as e:
+                await asyncio.sleep(e.retry_after)
+
+    async def _warm_username(self, username: str) -> None:
+        fetcher = self.handler.fetcher
+        profile = await self._retry(
+            lambda: fetcher.user_info_by_username(
+                WARMER_USER_ID, username, Priority.BULK
+            )
+        )
+        medias = await self._retry(
+            lambda: fetcher.user_medias(WARMER_USER_ID, profile.pk, self.posts)
+        )
+        for media in medias:
+            self.handler.cache_inline_results(media)
+
+    async def _warm_shortcode(self, shortcode: str) -> None:
+        media = await self._retry(
+            lambda: self.handler.fetcher.media_info(
+                WARMER_USER_ID, shortcode, Priority.BULK
+            )
+        )
+        self.handler.cache_inline_results(media)
+
+    async def run(self) -> None:
+        try:
+            text = await asyncio.to_thread(self.path.read_text)
+        except OSError:
+            logging.exception("Could not read the warm list %s", self.path)
+            return
+        entries = [
+            (kind, value)
+            for kind, value in parse_warm_list(text)
+            if self._is_mine(kind, value)
+        ]
+        logging.info("Warming the cache with %s entries", len(entries))
+        warmed = 0
+        for kind, value in entries:
+            try:
+                if kind == "username":
+                    await self._warm_username(value)
+                else:
+                    await self._warm_shortcode(value)
+            except Exception:
+                logging.exception("Could not warm %s %s", kind, value)
+                continue
+            warmed += 1
+        logging.info("Warmed %s of %s entries", warmed, len(entries))
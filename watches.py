@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import json
+import logging
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Union
+
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import Application, CallbackContext, JobQueue
+
+import deadlines
+from exceptions import Busy, CircuitOpen
+
+if TYPE_CHECKING:
+    from instagram import InstagramHandler
+
+WATCH_PATH = Path("watches.json")
+WATCH_INTERVAL = 30 * 60
+# Scheduler user the checks are queued under, so they share one fair-queue slot.
+# Real users are positive, 0 stands for updates without one, -1 is the warmer.
+WATCHER_USER_ID = -2
+
+ChatId = Union[int, str]
+
+
+class Watch:
+    """An Instagram account whose new posts are sent to some chats"""
+
+    ig_user_id: str
+    chats: List[ChatId]
+    last_seen: Optional[int]
+
+    def __init__(
+        self,
+        ig_user_id: str,
+        chats: Optional[List[ChatId]] = None,
+        last_seen: Optional[int] = None,
+    ) -> None:
+        self.ig_user_id = ig_user_id
+        self.chats = [] if chats is None else chats
+        self.last_seen = last_seen
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "ig_user_id": self.ig_user_id,
+            "chats": self.chats,
+            "last_seen": self.last_seen,
+        }
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> Watch:
+        return cls(data["ig_user_id"], data["chats"], data["last_seen"])
+
+
+def parse_chat(argument: str) -> ChatId:
+    """Returns a chat ID, or a public @username which the Bot API accepts too"""
+    try:
+        return int(argument)
+    except ValueError:
+        return argument if argument.startswith("@") else f"@{argument}"
+
+
+class AccountWatcher:
+    """
+    Checks watched accounts on a schedule and sends their new posts to chats.
+    Only the first page of posts is fetched, and compared with the newest post
+    seen by the previous check. Checks are spread evenly over the interval at
+    startup, later ones go into the longest gap so that no check is ever moved.
+    """
+
+    handler: InstagramHandler
+    path: Path
+    interval: float
+    watches: Dict[str, Watch]
+    _job_queue: Optional[JobQueue]
+
+    def __init__(
+        self,
+        handler: InstagramHandler,
+        path: Path = WATCH_PATH,
+        interval: float = WATCH_INTERVAL,
+    ) -> None:
+        self.handler = handler
+        self.path = path
+        self.interval = interval
+        self.watches = {}
+        self._job_queue = None
+        if path.exists():
+            self.watches = {
+                username: Watch.from_json(data)
+                for username, data in json.loads(path.read_text()).items()
+            }
+
+    def save(self) -> None:
+        self.path.write_text(
+            json.dumps(
+                {username: watch.to_json() for username, watch in self.watches.items()}
+            )
+        )
+
+    def start(self, application: Application) -> None:
+        if application.job_queue is None:
+            if len(self.watches) > 0:
+                logging.warning(
+                    "Install python-telegram-bot[job-queue] to check watched accounts"
+                )
+            return
+        self._job_queue = application.job_queue
+        # Spread evenly over the interval
+        for index, username in enumerate(sorted(self.watches)):
+            self._schedule(username, self.interval * (index + 1) / len(self.watches))
+
+    def _schedule(self, username: str, first: float) -> None:
+        if self._job_queue is None:
+            return
+        self._job_queue.run_repeating(
+            self.check,
+            self.interval,
+            first=first,
+            name=f"watch:{username}",
+            data=username,
+        )
+
+    def _add_check(self, username: str) -> None:
+        """
+        Schedules the check of a new watch in the middle of the longest gap
+        between the scheduled ones, which keep their times
+        """
+        if self._job_queue is None:
+            return
+        now = datetime.now(timezone.utc)
+        offsets = sorted(
+            (job.next_t - now).total_seconds() % self.interval
+            for job in self._job_queue.jobs()
+            if job.name is not None
+            and job.name.startswith("watch:")
+            and not job.removed
+            and job.next_t is not None
+        )
+        if len(offsets) == 0:
+            self._schedule(username, self.interval)
+            return
+        gap, start = max(
+            (end - start, start)
+            for start, end in zip(offsets, offsets[1:] + [offsets[0] + self.interval])
+        )
+        self._schedule(username, (start + gap / 2) % self.interval or self.interval)
+
+    def _remove_check(self, username: str) -> None:
+        if self._job_queue is None:
+            return
+        for job in self._job_queue.get_jobs_by_name(f"watch:{username}"):
+            job.schedule_removal()
+
+    async def check(self, context: CallbackContext) -> None:
+        """Sends the posts of an account that are newer than the last one seen"""
+        if context.job is None:
+            raise ValueError("Expected context.job to not be None.")
+        # Checks have no deadline, even when scheduled by /watch
+        deadlines.clear()
+        username: str = context.job.data  # type: ignore[assignment]
+        watch = self.watches.get(username)
+        if watch is None:
+            return
+        try:
+            medias = await self.handler.fetcher.user_medias(
+                WATCHER_USER_ID, watch.ig_user_id
+            )
+        except (CircuitOpen, Busy) as e:
+            logging.info("Skipping check of @%s: %s", username, e)
+            return
+        except Exception:
+            logging.exception("Could not check @%s", username)
+            return
+
+        # Pinned posts are old, so comparing pks skips them as well
+        new_medias = sorted(
+            (
+                media
+                for media in medias
+                if watch.last_seen is None or int(media.pk) > watch.last_seen
+            ),
+            key=lambda media: int(media.pk),
+        )
+        if len(new_medias) == 0:
+            return
+        if watch.last_seen is not None:
+            for media in new_medias:
+                for chat in watch.chats:
+                    try:
+                        await self.handler.send_post(context.bot, chat, media)
+                    except TelegramError:
+                        logging.exception(
+                            "Could not send %s of @%s to %s", media.code, username, chat
+                        )
+        watch.last_seen = int(new_medias[-1].pk)
+        self.save()
+
+    async def watch(self, update: Update, context: CallbackContext) -> None:
+        """Sends new posts of an account to this or the given chat"""
+        if update.message is None:
+            raise ValueError("Expected update.message to not be None.")
+        if (context.args is None) or (len(context.args) < 1):
+            await update.message.reply_text(
+                "Please run the command with a profile username, and optionally a chat.",
+                quote=True,
+            )
+            return
+        username = context.args[0].lstrip("@").lower()
+        chat = (
+            parse_chat(context.args[1])
+            if len(context.args) > 1
+            else update.message.chat_id
+        )
+
+        watch = self.watches.get(username)
+        if watch is None:
+            user = await self.handler.fetcher.user_info_by_username(
+                0 if update.effective_user is None else update.effective_user.id,
+                username,
+            )
+            # Another /watch of the account may have added it in the meantime
+            watch = self.watches.get(username)
+            if watch is None:
+                watch = self.watches[username] = Watch(user.pk)
+                self._add_check(username)
+        if chat not in watch.chats:
+            watch.chats.append(chat)
+        self.save()
+        await update.message.reply_text(
+            f"New posts of @{username} will be sent to {chat}", quote=True
+        )
+
+    async def unwatch(self, update: Update, context: CallbackContext) -> None:
+        """Stops sending new posts of an account to this or the given chat"""
+        if update.message is None:
+            raise ValueError("Expected update.message to not be None.")
+        if (context.args is None) or (len(context.args) < 1):
+            await update.message.reply_text(
+                "Please run the command with a profile username, and optionally a chat.",
+                quote=True,
+            )
+            return
+        username = context.args[0].lstrip("@").lower()
+        chat = (
+            parse_chat(context.args[1])
+            if len(context.args) > 1
+            else update.message.chat_id
+        )
+
+        watch = self.watches.get(username)
+        if watch is None or chat not in watch.chats:
+            await update.message.reply_text(
+                f"@{username} is not watched in {chat}", quote=True
+            )
+            return
+        watch.chats.remove(chat)
+        if len(watch.chats) == 0:
+            del self.watches[username]
+            self._remove_check(username)
+        self.save()
+        await update.message.reply_text(
+            f"Stopped sending posts of @{username} to {chat}", quote=True
+        )